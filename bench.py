@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+
+"""Simulation benchmarks of the Microscope gateware.
+
+Each scenario instantiates ``Microscope`` with a set of inserts and runs the
+protocol commands through the real PHY (UART or SPI), driven at the bit level
+by a simulated host. Cycle counts and throughputs are reported per operation,
+together with the size of the elaborated design.
+"""
+
+import re
+import json
+import argparse
+import struct
+
+from migen import *
+from migen.sim import passive
+from migen.fhdl.verilog import convert
+
+import prettytable
+
+from microscope.inserts import InsertRegistry, ProbeSingle, ProbeBuffer
+from microscope.config import get_config_from_inserts
+from microscope.core import Microscope
+from microscope.spi import SPISlave
+from microscope.microscope import decompress, crc16
+
+
+magic = b"\x1a\xe5\x52\x9c"
+
+
+class SerialPads:
+    def __init__(self):
+        self.rx = Signal(reset=1)
+        self.tx = Signal(reset=1)
+
+
+class SPIPads:
+    def __init__(self):
+        self.clk = Signal()
+        self.cs_n = Signal(reset=1)
+        self.mosi = Signal()
+        self.miso = Signal()
+
+
+class UARTModel:
+    """Host side of the serial link. Bytes sent by the device are decoded in
+    the background by ``receiver``, together with the cycle at which their
+    stop bit was sampled."""
+    def __init__(self, pads, bit_cycles):
+        self.pads = pads
+        self.bit_cycles = bit_cycles
+        self.cycle = 0
+        self.received = []
+
+    @passive
+    def clock(self):
+        while True:
+            yield
+            self.cycle += 1
+
+    @passive
+    def receiver(self):
+        while True:
+            while (yield self.pads.tx):
+                yield
+            for _ in range(self.bit_cycles//2):
+                yield
+            if (yield self.pads.tx):
+                continue
+            byte = 0
+            for i in range(8):
+                for _ in range(self.bit_cycles):
+                    yield
+                byte |= (yield self.pads.tx) << i
+            for _ in range(self.bit_cycles):
+                yield
+            if (yield self.pads.tx):
+                self.received.append(byte)
+
+    def write(self, data):
+        for byte in data:
+            bits = [0] + [(byte >> i) & 1 for i in range(8)] + [1]
+            for bit in bits:
+                yield self.pads.rx.eq(bit)
+                for _ in range(self.bit_cycles):
+                    yield
+
+    def read(self, n, timeout):
+        start = self.cycle
+        while len(self.received) < n:
+            if self.cycle - start > timeout:
+                raise TimeoutError("Device did not reply")
+            yield
+        data = bytes(self.received[:n])
+        del self.received[:n]
+        return data
+
+    def read_idle(self, idle):
+        """Reads until the device has been silent for ``idle`` cycles."""
+        received = len(self.received)
+        last = self.cycle
+        while self.cycle - last < idle:
+            if len(self.received) != received:
+                received = len(self.received)
+                last = self.cycle
+            yield
+        data = bytes(self.received)
+        del self.received[:]
+        return data
+
+    def processes(self):
+        return [self.clock(), self.receiver()]
+
+
+class SPIModel:
+    """Host side of an SPI link, with the same interface as ``UARTModel``.
+    ``bit_cycles`` is the period of the SPI clock. Like the host transport,
+    reads poll the device with transfers of ``poll_transfer`` bytes, and of
+    up to ``max_transfer`` bytes once data flows."""
+    def __init__(self, pads, bit_cycles, max_transfer=255, poll_transfer=16):
+        self.pads = pads
+        self.bit_cycles = bit_cycles
+        self.max_transfer = max_transfer
+        self.poll_transfer = poll_transfer
+        self.cycle = 0
+        self.received = []
+
+    @passive
+    def clock(self):
+        while True:
+            yield
+            self.cycle += 1
+
+    def transfer(self, length, data=b""):
+        half_period = self.bit_cycles//2
+        yield self.pads.cs_n.eq(0)
+        for _ in range(half_period):
+            yield
+        sent = bytes([length, len(data)]) + data + bytes(length - len(data))
+        reply = []
+        for byte in sent:
+            received = 0
+            for i in reversed(range(8)):
+                yield self.pads.mosi.eq((byte >> i) & 1)
+                for _ in range(half_period):
+                    yield
+                received = (received << 1) | (yield self.pads.miso)
+                yield self.pads.clk.eq(1)
+                for _ in range(half_period):
+                    yield
+                yield self.pads.clk.eq(0)
+            reply.append(received)
+        for _ in range(half_period):
+            yield
+        yield self.pads.cs_n.eq(1)
+        for _ in range(self.bit_cycles):
+            yield
+        self.received += reply[2:2+reply[1]]
+        return reply[1]
+
+    def write(self, data):
+        for i in range(0, len(data), self.max_transfer):
+            chunk = data[i:i+self.max_transfer]
+            yield from self.transfer(len(chunk), chunk)
+
+    def read(self, n, timeout):
+        start = self.cycle
+        length = self.poll_transfer
+        while len(self.received) < n:
+            if self.cycle - start > timeout:
+                raise TimeoutError("Device did not reply")
+            if (yield from self.transfer(min(n - len(self.received), length))):
+                length = self.max_transfer
+            else:
+                length = self.poll_transfer
+        data = bytes(self.received[:n])
+        del self.received[:n]
+        return data
+
+    def read_idle(self, idle):
+        last = self.cycle
+        while self.cycle - last < idle:
+            if (yield from self.transfer(self.poll_transfer)):
+                last = self.cycle
+        data = bytes(self.received)
+        del self.received[:]
+        return data
+
+    def processes(self):
+        return [self.clock()]
+
+
+class Scenario:
+    def __init__(self, name, singles=0, buffers=0, width=32, depth=64,
+                 compression=False, mux_pipeline=0, phy="uart", decimation=None,
+                 double_buffered=False):
+        self.name = name
+        self.singles = singles
+        self.buffers = buffers
+        self.width = width
+        self.depth = depth
+        self.compression = compression
+        self.mux_pipeline = mux_pipeline
+        self.phy = phy
+        self.decimation = decimation
+        self.double_buffered = double_buffered
+
+
+scenarios = [
+    Scenario("singles", singles=8, width=32),
+    Scenario("buffers", singles=1, buffers=4, width=32, depth=32),
+    Scenario("wide", singles=1, buffers=1, width=256, depth=16),
+    Scenario("compressed", singles=1, buffers=2, width=32, depth=64, compression=True),
+    # The same inserts behind a flat and a pipelined insert mux, to compare
+    # their elaborated resources. Fmax needs synthesis, and is not measured.
+    Scenario("many", singles=24, buffers=2, width=16, depth=8, mux_pipeline=2),
+    Scenario("many-flat", singles=24, buffers=2, width=16, depth=8),
+    Scenario("spi", singles=1, buffers=4, width=32, depth=32, phy="spi"),
+    # More inserts than fit in the 12 bytes of the window parameters, so
+    # that the group parameters widen the payload register.
+    Scenario("crowded", singles=70, buffers=1, width=8, depth=16),
+    # Captures that take about as long as their readback.
+    Scenario("decimated", buffers=1, width=16, depth=8, decimation=512),
+    Scenario("double", buffers=1, width=16, depth=8, decimation=512, double_buffered=True),
+]
+
+
+class BenchDesign(Module):
+    def __init__(self, scenario, sys_clk_freq, baudrate):
+        if scenario.phy == "spi":
+            self.pads = SPIPads()
+            phy = SPISlave(self.pads)
+            self.ios = {self.pads.clk, self.pads.cs_n, self.pads.mosi, self.pads.miso}
+        else:
+            self.pads = SerialPads()
+            phy = None
+            self.ios = {self.pads.rx, self.pads.tx}
+        registry = InsertRegistry()
+        # Microscope creates the logic of the inserts when it is finalized,
+        # which must happen before the inserts are.
+        self.submodules.microscope = Microscope(self.pads, sys_clk_freq, registry,
+                                                baudrate=baudrate, baudrates=[],
+                                                compression=scenario.compression,
+                                                mux_pipeline=scenario.mux_pipeline,
+                                                phy=phy)
+        self.scenario = scenario
+
+        counter = Signal(scenario.width)
+        self.sync += counter.eq(counter + 1)
+        self.inserts = []
+        for i in range(scenario.singles):
+            self.inserts.append(ProbeSingle(registry, "singles", "s{}".format(i),
+                                            (counter + i)[:scenario.width]))
+        for i in range(scenario.buffers):
+            self.inserts.append(ProbeBuffer(registry, "buffers", "b{}".format(i),
+                                            (counter + i)[:scenario.width],
+                                            depth=scenario.depth,
+                                            decimation_width=16 if scenario.decimation else 0,
+                                            double_buffered=scenario.double_buffered))
+        self.submodules += self.inserts
+
+    def get_config(self):
+        return get_config_from_inserts(self.inserts, self.microscope.baudrates,
+                                       self.microscope.compression,
+                                       self.microscope.sys_clk_freq)
+
+
+class Operation:
+    def __init__(self, name, sent, received, payload, cycles):
+        self.name = name
+        self.sent = sent
+        self.received = received
+        self.payload = payload
+        self.cycles = cycles
+
+
+def run_operations(design, model, operations, timeout):
+    config = design.get_config()
+    singles = [insert for insert in design.inserts if isinstance(insert, ProbeSingle)]
+    buffers = [insert for insert in design.inserts if isinstance(insert, ProbeBuffer)]
+    single_len = sum((len(insert.target)+7)//8 for insert in singles)
+
+    def operation(name, command, reply_len, payload=None):
+        start = model.cycle
+        yield from model.write(command)
+        reply = yield from model.read(reply_len, timeout)
+        if payload is None:
+            payload = reply_len
+        operations.append(Operation(name, len(command), reply_len, payload,
+                                    model.cycle - start))
+        return reply
+
+    # Let the device come out of reset with an idle line.
+    for _ in range(4*model.bit_cycles):
+        yield
+
+    reply = yield from operation("config", magic + b"\x00", len(config))
+    if reply != config:
+        raise ValueError("Config mismatch")
+    yield from operation("config hash", magic + b"\x09", 16)
+    yield from operation("pending", magic + b"\x03", 1)
+    if singles:
+        yield from operation("snapshot", magic + b"\x07\xff", single_len)
+    for n, insert in enumerate(design.inserts):
+        if insert not in buffers:
+            continue
+        word_len = (len(insert.data)+7)//8
+        start = model.cycle
+        yield from model.write(magic + b"\x01" + struct.pack("B", n))
+        operations.append(Operation("select", 6, 0, 0, model.cycle - start))
+        yield from operation("arm-wait", magic + b"\x08", 1, 0)
+        data = yield from operation("data", magic + b"\x04", insert.depth*word_len)
+        chunk_len = 16*word_len
+        checked = yield from operation("checked data", magic + b"\x0f" + struct.pack("<H", 16),
+                                       len(data) + 2*(-(-len(data)//chunk_len)), len(data))
+        chunks = [checked[i:i+chunk_len+2] for i in range(0, len(checked), chunk_len+2)]
+        if (b"".join(chunk[:-2] for chunk in chunks) != data
+                or any(crc16(chunk[:-2]) != struct.unpack("<H", chunk[-2:])[0]
+                       for chunk in chunks)):
+            raise ValueError("Checked readback mismatch")
+        # Every other sample from the second one. Selecting the insert again
+        # clears the window.
+        w_count = insert.depth//2
+        yield from model.write(magic + b"\x0a" + struct.pack("<III", 1, w_count, 2))
+        windowed = yield from operation("windowed data", magic + b"\x04", w_count*word_len)
+        if windowed != b"".join(data[i*word_len:(i+1)*word_len]
+                                for i in range(1, 2*w_count, 2)):
+            raise ValueError("Windowed readback mismatch")
+        yield from model.write(magic + b"\x01" + struct.pack("B", n))
+        if design.microscope.compression:
+            start = model.cycle
+            yield from model.write(magic + b"\x06")
+            compressed = yield from model.read_idle(4*10*model.bit_cycles)
+            operations.append(Operation("compressed data", 5, len(compressed), len(data),
+                                        model.cycle - start - 4*10*model.bit_cycles))
+            stream = iter(compressed)
+            if decompress(lambda n: bytes(next(stream) for _ in range(n)),
+                          len(insert.data), insert.depth) != data:
+                raise ValueError("Compressed readback mismatch")
+        if design.scenario.decimation:
+            # Back-to-back captures and readbacks. The first one is not
+            # counted, as it starts the capture pipeline of double-buffered
+            # inserts.
+            yield from model.write(magic + b"\x11" +
+                                   struct.pack("<I", design.scenario.decimation - 1))
+            for i in range(3):
+                start = model.cycle
+                yield from model.write(magic + b"\x08")
+                yield from model.read(1, timeout)
+                yield from model.write(magic + b"\x04")
+                yield from model.read(len(data), timeout)
+                if i:
+                    operations.append(Operation("repeated capture", 10, 1 + len(data),
+                                                len(data), model.cycle - start))
+    if len(buffers) > 1:
+        mask = 0
+        for n, insert in enumerate(design.inserts):
+            if insert in buffers:
+                mask |= 1 << n
+        mask = mask.to_bytes((len(design.inserts)+7)//8, "little")
+        yield from operation("group arm-wait", magic + b"\x0c\x00" + mask, 1, 0)
+        lengths = [insert.depth*((len(insert.data)+7)//8) for insert in buffers]
+        data = yield from operation("group data", magic + b"\x0d", sum(lengths))
+        checked = yield from operation("checked group data", magic + b"\x13",
+                                       sum(lengths) + 2*len(lengths), sum(lengths))
+        # Each insert is followed by its CRC.
+        offset = 0
+        for n, length in enumerate(lengths):
+            insert_data = checked[offset+2*n:offset+2*n+length]
+            crc = struct.unpack("<H", checked[offset+2*n+length:offset+2*n+length+2])[0]
+            if insert_data != data[offset:offset+length] or crc16(insert_data) != crc:
+                raise ValueError("Checked group readback mismatch")
+            offset += length
+
+
+def get_resources(design):
+    verilog = str(convert(design, ios=design.ios))
+    resources = {"regs": 0, "reg_bits": 0, "wires": 0, "wire_bits": 0,
+                 "memories": 0, "memory_bits": 0}
+    for line in verilog.splitlines():
+        m = re.match(r"\s*(reg|wire)\s*(?:\[(\d+):0\])?\s*\w+\s*(\[0:(\d+)\])?", line)
+        if m is None:
+            continue
+        kind, msb, memory, last = m.groups()
+        width = 1 if msb is None else int(msb) + 1
+        if memory is not None:
+            resources["memories"] += 1
+            resources["memory_bits"] += width*(int(last) + 1)
+        else:
+            resources[kind + "s"] += 1
+            resources[kind + "_bits"] += width
+    return resources
+
+
+def run_scenario(scenario, sys_clk_freq, bit_cycles, spi_cycles):
+    baudrate = sys_clk_freq/bit_cycles
+    design = BenchDesign(scenario, sys_clk_freq, baudrate)
+    design.finalize()
+    if scenario.phy == "spi":
+        model = SPIModel(design.pads, spi_cycles)
+    else:
+        model = UARTModel(design.pads, bit_cycles)
+    operations = []
+    run_simulation(design,
+                   [run_operations(design, model, operations,
+                                   100*len(design.get_config())*model.bit_cycles)] +
+                   model.processes(),
+                   clocks={"sys": 10, "microscope": 10})
+
+    resources = get_resources(BenchDesign(scenario, sys_clk_freq, baudrate))
+    return operations, resources
+
+
+def summarize(operations, sys_clk_freq):
+    summary = {}
+    for operation in operations:
+        entry = summary.setdefault(operation.name, {
+            "count": 0, "cycles": 0, "line_bytes": 0, "payload_bytes": 0})
+        entry["count"] += 1
+        entry["cycles"] += operation.cycles
+        entry["line_bytes"] += operation.sent + operation.received
+        entry["payload_bytes"] += operation.payload
+    for entry in summary.values():
+        seconds = entry["cycles"]/sys_clk_freq
+        entry["cycles_per_op"] = entry["cycles"]/entry["count"]
+        entry["ops_per_s"] = entry["count"]/seconds
+        entry["payload_bytes_per_s"] = entry["payload_bytes"]/seconds
+        # Bytes on the line per payload byte. Compressed readbacks are
+        # below one.
+        if entry["payload_bytes"]:
+            entry["line_per_payload"] = entry["line_bytes"]/entry["payload_bytes"]
+        else:
+            entry["line_per_payload"] = None
+    return summary
+
+
+def print_results(name, summary, resources):
+    print("Scenario: " + name)
+    table = prettytable.PrettyTable(["Operation", "Cycles/op", "Ops/s", "Payload B/s",
+                                     "Line bytes", "Payload bytes", "Line/payload"])
+    for op_name, entry in summary.items():
+        line_per_payload = entry["line_per_payload"]
+        table.add_row([op_name, round(entry["cycles_per_op"]), round(entry["ops_per_s"], 1),
+                       round(entry["payload_bytes_per_s"]), entry["line_bytes"],
+                       entry["payload_bytes"],
+                       "-" if line_per_payload is None else round(line_per_payload, 3)])
+    print(table)
+    print(", ".join("{}: {}".format(k, v) for k, v in resources.items()))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microscope simulation benchmarks")
+    parser.add_argument("scenario", nargs="*",
+                        help="scenarios to run (default: all, choices: {})".format(
+                             ", ".join(scenario.name for scenario in scenarios)))
+    parser.add_argument("--sys-clk-freq", type=float, default=16e6,
+                        help="system clock frequency, for throughputs (default: %(default)s)")
+    parser.add_argument("--bit-cycles", type=int, default=16,
+                        help="clock cycles per UART bit (default: %(default)s)")
+    parser.add_argument("--spi-cycles", type=int, default=10,
+                        help="clock cycles per SPI clock period (default: %(default)s)")
+    parser.add_argument("--json", action="store_true",
+                        help="print machine-readable results")
+    args = parser.parse_args()
+
+    selected = [scenario for scenario in scenarios
+                if not args.scenario or scenario.name in args.scenario]
+    results = {}
+    for scenario in selected:
+        operations, resources = run_scenario(scenario, args.sys_clk_freq, args.bit_cycles,
+                                             args.spi_cycles)
+        summary = summarize(operations, args.sys_clk_freq)
+        results[scenario.name] = {"operations": summary, "resources": resources}
+        if not args.json:
+            print_results(scenario.name, summary, resources)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
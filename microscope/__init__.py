@@ -1,2 +1,3 @@
-from microscope.globals import add_probe_async, add_probe_single, add_probe_buffer
+from microscope.globals import (add_probe_async, add_probe_single, add_probe_counter,
+                                add_probe_buffer, add_probe_histogram)
 from microscope.core import Microscope
@@ -0,0 +1,141 @@
+"""asyncio interface to Microscope devices.
+
+Each ``AsyncComm`` runs the blocking ``Comm`` of one device in its own
+worker thread, so that one event loop can drive many devices at once.
+Calls on the same device are executed in order.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from microscope.microscope import (Comm, Capture, get_insert_options, get_word_width,
+                                   get_readback_depth)
+
+
+__all__ = ["AsyncComm"]
+
+
+class AsyncComm:
+    """Asynchronous connection to one device. ``timeout`` (in seconds)
+    applies to each call that waits for the device. Use ``open`` to create
+    instances."""
+    def __init__(self, comm, executor, timeout):
+        self.comm = comm
+        self.executor = executor
+        self.timeout = timeout
+        # Held by multi-command sequences such as capture(), to keep other
+        # tasks from changing the selection in the middle.
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, port_url, baudrate=115200, cache_dir=None, timeout=5.0):
+        executor = ThreadPoolExecutor(max_workers=1)
+        loop = asyncio.get_running_loop()
+        try:
+            comm = await loop.run_in_executor(executor, Comm, port_url, baudrate, cache_dir)
+        except Exception:
+            executor.shutdown(wait=False)
+            raise
+        # Serial reads must return eventually, so that a timed out call
+        # does not hold the worker thread.
+        comm.ser.timeout = timeout
+        return cls(comm, executor, timeout)
+
+    def _call(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, function, *args)
+
+    async def _run(self, function, *args):
+        try:
+            return await asyncio.wait_for(self._call(function, *args), self.timeout)
+        except asyncio.TimeoutError:
+            # The worker thread still completes the call, and the rest of
+            # its reply would be read by the next one.
+            self._call(self._drain)
+            raise
+
+    def _drain(self):
+        time.sleep(0.05)
+        self.comm.ser.reset_input_buffer()
+
+    async def close(self):
+        try:
+            await self._run(self.comm.close)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_config(self):
+        return await self._run(self.comm.get_config)
+
+    async def negotiate_baudrate(self, max_baudrate=None):
+        # Takes several serial timeouts when rates are rejected.
+        return await self._call(self.comm.negotiate_baudrate, max_baudrate)
+
+    async def select(self, insert):
+        await self._run(self.comm.select, insert)
+
+    async def arm(self):
+        await self._run(self.comm.arm)
+
+    async def arm_group(self, inserts, cross_trigger=False):
+        await self._run(self.comm.arm_group, inserts, cross_trigger)
+
+    async def pending(self):
+        return await self._run(self.comm.pending)
+
+    async def arm_wait(self, inserts=None, cross_trigger=False, timeout=None):
+        """Arms the selected insert, or all ``inserts`` in the same cycle,
+        and waits until they have captured, without polling. Raises
+        ``asyncio.TimeoutError`` if ``timeout`` expires first."""
+        if inserts is None:
+            done = await self._call(self.comm.arm_wait, timeout)
+        else:
+            done = await self._call(self.comm.arm_group_wait, inserts, cross_trigger, timeout)
+        if not done:
+            raise asyncio.TimeoutError("Timeout waiting for trigger")
+
+    async def wait(self, timeout=None, interval=0.01):
+        """Waits until the selected insert, armed with ``arm``, has captured,
+        by polling. Raises ``asyncio.TimeoutError`` if ``timeout`` expires
+        first."""
+        async def poll():
+            while await self.pending():
+                await asyncio.sleep(interval)
+        await asyncio.wait_for(poll(), timeout)
+
+    async def set_trigger(self, registers):
+        await self._run(self.comm.set_trigger, registers)
+
+    async def read(self, length):
+        """Reads back ``length`` bytes of the selected insert."""
+        data = await self._run(self.comm.data, length)
+        if len(data) != length:
+            raise asyncio.TimeoutError("Incomplete readback")
+        return data
+
+    async def set_window(self, start, count, stride=1):
+        await self._run(self.comm.set_window, start, count, stride)
+
+    async def capture(self, insert, timeout=None):
+        """Arms the insert with the given index, waits for it to capture and
+        reads back its complete contents as a ``Capture``."""
+        config = await self.get_config()
+        group, name, width, depth, *_ = config["ins"][insert]
+        options = get_insert_options(config["ins"][insert])
+        count = get_readback_depth(width, depth, options)
+        word_len = (get_word_width(width, options)+7)//8
+        async with self.lock:
+            await self.select(insert)
+            await self.arm_wait(timeout=timeout)
+            if config.get("crc", False):
+                data = await self._run(self.comm.data_verified, word_len, 0, count)
+            else:
+                data = await self.read(count*word_len)
+        return Capture(config["grp"][group], name, width, depth, options, 0, 1, data)
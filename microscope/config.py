@@ -1,16 +1,23 @@
+import hashlib
+
 import msgpack
 
 from microscope.inserts import *
 
 
-__all__ = ["get_config_from_inserts"]
+__all__ = ["get_groups_from_inserts", "get_config_from_inserts", "get_config_hash"]
 
 
-def get_config_from_inserts(inserts):
-    config_groups = []
+def get_groups_from_inserts(inserts):
+    groups = []
     for insert in inserts:
-        if insert.group not in config_groups:
-            config_groups.append(insert.group)
+        if insert.group not in groups:
+            groups.append(insert.group)
+    return groups
+
+
+def get_config_from_inserts(inserts, baudrates=None, compression=False, clk_freq=None):
+    config_groups = get_groups_from_inserts(inserts)
 
     config_inserts = []
     for insert in inserts:
@@ -18,14 +25,59 @@ def get_config_from_inserts(inserts):
                    insert.name]
         if isinstance(insert, (ProbeAsync, ProbeSingle)):
             element += [len(insert.data), 1]
+        elif isinstance(insert, ProbeCounter):
+            element += [len(insert.data), 1]
+            options = {"cnt": insert.width}
+            counter_clk_freq = insert.clk_freq
+            if counter_clk_freq is None and insert.clock_domain == "sys":
+                counter_clk_freq = clk_freq
+            if counter_clk_freq is not None:
+                options["clk"] = round(counter_clk_freq)
+            element.append(options)
         elif isinstance(insert, ProbeBuffer):
-            element += [len(insert.data), insert.depth]
+            element += [len(insert.target), insert.depth]
+            options = {}
+            if insert.segments > 1:
+                options["seg"] = insert.segments
+                options["tsw"] = insert.timestamp_width
+            if insert.delta_width:
+                options["dtw"] = insert.delta_width
+            if insert.programmable_trigger:
+                options["trg"] = insert.sequence_width
+            if insert.pretrigger:
+                options["pre"] = insert.pretrigger
+            if insert.decimation_width:
+                options["dec"] = insert.decimation_width
+            if insert.double_buffered:
+                options["dbl"] = True
+            # The sample clock frequency, for the timeline of captures.
+            if insert.clock_domain == "sys" and clk_freq is not None:
+                options["clk"] = round(clk_freq)
+            if options:
+                element.append(options)
+        elif isinstance(insert, ProbeHistogram):
+            element += [insert.counter_width, insert.depth]
+            options = {"bin": insert.bin_width}
+            if insert.duration is not None:
+                options["dur"] = insert.duration
+            element.append(options)
         else:
             raise ValueError
         config_inserts.append(element)
 
     config = {
         "grp": config_groups,
-        "ins": config_inserts
+        "ins": config_inserts,
+        "crc": True
     }
+    if baudrates is not None:
+        config["bdr"] = baudrates
+    if compression:
+        config["cmp"] = True
+    if clk_freq is not None:
+        config["clk"] = round(clk_freq)
     return msgpack.packb(config, use_bin_type=True)
+
+
+def get_config_hash(config):
+    return hashlib.sha256(config).digest()[:16]
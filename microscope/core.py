@@ -1,8 +1,12 @@
+from functools import reduce
+from operator import or_
+
 from migen import *
 from migen.genlib.fsm import *
 
 from microscope.globals import registry as global_registry
 from microscope.config import *
+from microscope.inserts import ProbeCounter
 from microscope.uart import UART
 
 
@@ -32,9 +36,31 @@ class ConfigROM(Module):
         ]
 
 
+def crc16_update(crc, data):
+    """Returns the CRC-16/CCITT (polynomial 0x1021) of the 8-bit ``data``
+    appended to a message with a CRC of ``crc``."""
+    bits = [crc[i] for i in range(16)]
+    for i in reversed(range(8)):
+        feedback = data[i] ^ bits[15]
+        bits = [feedback] + [bits[j-1] ^ feedback if j in (5, 12) else bits[j-1]
+                             for j in range(1, 16)]
+    return Cat(*bits)
+
+
+def get_readback_depth(insert):
+    return getattr(insert, "readback_depth", getattr(insert, "depth", 1))
+
+
 class InsertMux(Module):
-    def __init__(self, inserts):
-        max_depth = max(getattr(insert, "depth", 1) for insert in inserts)
+    """Multiplexes the inserts to the protocol engine.
+
+    With ``pipeline`` set to a non-zero value, the outputs that depend on
+    ``sel`` are selected by a registered tree of that many stages instead
+    of a single flat multiplexer. They are then valid ``latency`` cycles
+    after ``sel``, ``address`` or an arm change.
+    """
+    def __init__(self, inserts, pipeline=0):
+        max_depth = max(get_readback_depth(insert) for insert in inserts)
         max_width = max(len(insert.data) for insert in inserts)
 
         if len(inserts) > 1:
@@ -47,29 +73,141 @@ class InsertMux(Module):
         self.last_address = Signal(max=max(max_depth, 2))
         self.last_byte = Signal(max=max((max_width+7)//8, 2))
 
+        # Snapshot of all single-value inserts of a group (0xff for all
+        # groups). snapshot_match indicates whether the selected insert
+        # takes part in the snapshot.
+        self.snapshot_group = Signal(8)
+        self.snapshot_arm = Signal()
+        self.snapshot_pending = Signal()
+        self.snapshot_match = Signal()
+        self.last_sel = Signal()
+
+        # Group arm: arm_group arms all inserts of arm_mask in the same cycle.
+        # With cross_trigger set, the trigger of any of the buffers armed
+        # that way also triggers the others. group_match indicates whether
+        # the selected insert belongs to the group.
+        self.arm_mask = Signal(len(inserts))
+        self.arm_group = Signal()
+        self.cross_trigger = Signal()
+        self.group_pending = Signal()
+        self.group_match = Signal()
+
+        # Registers of the programmable trigger of the selected insert.
+        self.trigger_data = Signal(8)
+        self.trigger_stb = Signal()
+        self.trigger_commit = Signal()
+
+        # Decimation factor minus one of the selected insert.
+        self.decimation = Signal(32)
+        self.decimation_load = Signal()
+
+        self.latency = pipeline
+
         # # #
 
         if len(inserts) > 1:
             sel = self.sel
         else:
             sel = 0
+        self.comb += self.last_sel.eq(sel == len(inserts)-1)
+        groups = get_groups_from_inserts(inserts)
+        snapshot_matches = []
+        for insert in inserts:
+            # Arming a counter clears it, so counters are left out of
+            # snapshots and read with group arms instead.
+            if getattr(insert, "depth", 1) == 1 and not isinstance(insert, ProbeCounter):
+                snapshot_match = Signal()
+                self.comb += snapshot_match.eq((self.snapshot_group == 0xff) |
+                                               (self.snapshot_group == groups.index(insert.group)))
+            else:
+                snapshot_match = 0
+            snapshot_matches.append(snapshot_match)
         self.comb += [
-            self.pending.eq(Array(getattr(insert, "pending", 0) for insert in inserts)[sel]),
-            self.data.eq(Array(insert.data for insert in inserts)[sel])
+            self.snapshot_pending.eq(reduce(or_, [getattr(insert, "pending", 0) & snapshot_match
+                for insert, snapshot_match in zip(inserts, snapshot_matches)])),
+            self.group_pending.eq(reduce(or_, [getattr(insert, "pending", 0) & self.arm_mask[n]
+                for n, insert in enumerate(inserts)]))
         ]
         for n, insert in enumerate(inserts):
             if hasattr(insert, "arm"):
-                self.comb += insert.arm.eq(self.arm & (sel == n))
+                self.comb += insert.arm.eq((self.arm & (sel == n)) |
+                                           (self.snapshot_arm & snapshot_matches[n]) |
+                                           (self.arm_group & self.arm_mask[n]))
+            if hasattr(insert, "trigger_in"):
+                others = [other.trigger_out & self.arm_mask[m]
+                          for m, other in enumerate(inserts)
+                          if m != n and hasattr(other, "trigger_out")]
+                if others:
+                    self.comb += insert.trigger_in.eq(self.cross_trigger & self.arm_mask[n] &
+                                                      reduce(or_, others))
             if hasattr(insert, "address"):
                 self.comb += insert.address.eq(self.address)
-        self.comb += [
-            self.last_address.eq(Array(getattr(insert, "depth", 1)-1 for insert in inserts)[sel]),
-            self.last_byte.eq(Array((len(insert.data)+7)//8-1 for insert in inserts)[sel])
+            if hasattr(insert, "trigger_unit"):
+                self.comb += [
+                    insert.trigger_unit.load_data.eq(self.trigger_data),
+                    insert.trigger_unit.load_stb.eq(self.trigger_stb & (sel == n)),
+                    insert.trigger_unit.load_commit.eq(self.trigger_commit & (sel == n))
+                ]
+            if hasattr(insert, "decimation_load"):
+                self.comb += [
+                    insert.decimation.eq(self.decimation),
+                    insert.decimation_load.eq(self.decimation_load & (sel == n))
+                ]
+
+        outputs = [
+            (self.data, [insert.data for insert in inserts]),
+            (self.pending, [getattr(insert, "pending", 0) for insert in inserts]),
+            (self.last_address, [get_readback_depth(insert)-1 for insert in inserts]),
+            (self.last_byte, [(len(insert.data)+7)//8-1 for insert in inserts]),
+            (self.snapshot_match, snapshot_matches),
+            (self.group_match, [self.arm_mask[n] for n in range(len(inserts))])
         ]
+        if pipeline:
+            self.create_mux_tree(outputs, sel, pipeline)
+        else:
+            self.comb += [output.eq(Array(values)[sel]) for output, values in outputs]
+
+    def create_mux_tree(self, outputs, sel, pipeline):
+        # All outputs are packed into one word per insert. Each stage selects
+        # with the next bits of sel, starting from the least significant.
+        width = sum(len(output) for output, values in outputs)
+        words = []
+        for values in zip(*(values for output, values in outputs)):
+            word = Signal(width)
+            offset = 0
+            for (output, _), value in zip(outputs, values):
+                self.comb += word[offset:offset+len(output)].eq(value)
+                offset += len(output)
+            words.append(word)
+
+        if isinstance(sel, int):
+            sel_bits = []
+        else:
+            sel_bits = [sel[i] for i in range(len(sel))]
+        stage_bits = -(-len(sel_bits)//pipeline) if sel_bits else 1
+        for stage in range(pipeline):
+            stage_sel = sel_bits[stage*stage_bits:(stage+1)*stage_bits]
+            radix = 2**len(stage_sel)
+            stage_words = []
+            for i in range(0, len(words), radix):
+                stage_word = Signal(width)
+                choices = words[i:i+radix]
+                if len(choices) > 1:
+                    self.sync.microscope += stage_word.eq(Array(choices)[Cat(*stage_sel)])
+                else:
+                    self.sync.microscope += stage_word.eq(choices[0])
+                stage_words.append(stage_word)
+            words = stage_words
+
+        offset = 0
+        for output, _ in outputs:
+            self.comb += output.eq(words[0][offset:offset+len(output)])
+            offset += len(output)
 
 
 class SerialProtocolEngine(Module):
-    def __init__(self, config_rom, imux, timeout_cycles):
+    def __init__(self, config_rom, config_hash_rom, imux, timeout_cycles, tuning_words,
+                 compression=False):
         self.rx_data = Signal(8)
         self.rx_stb = Signal()
 
@@ -77,13 +215,16 @@ class SerialProtocolEngine(Module):
         self.tx_stb = Signal()
         self.tx_ack = Signal()
 
+        self.tuning_word = Signal(32, reset=tuning_words[0])
+
         # # #
 
         timeout = Signal()
+        keepalive = Signal()
         timeout_counter = Signal(max=timeout_cycles + 1, reset=timeout_cycles)
         self.sync += [
             timeout.eq(0),
-            If(self.tx_stb | self.rx_stb,
+            If(self.tx_stb | self.rx_stb | keepalive,
                 timeout_counter.eq(timeout_cycles)
             ).Else(
                 If(timeout_counter == 0,
@@ -94,46 +235,350 @@ class SerialProtocolEngine(Module):
                 )
             )
         ]
-        
+
+        # A new baud rate stays on probation until the host confirms it with
+        # command 0x12, which it sends once it has received a reply at that
+        # rate. Otherwise, the next timeout brings it back to the default
+        # rate.
+        tuning_word_load = Signal()
+        tuning_word_confirm = Signal()
+        tuning_word_probation = Signal()
+        self.sync += [
+            If(tuning_word_confirm,
+                tuning_word_probation.eq(0)
+            ),
+            If(timeout & tuning_word_probation,
+                self.tuning_word.eq(tuning_words[0]),
+                tuning_word_probation.eq(0)
+            ),
+            If(tuning_word_load,
+                Case(self.rx_data, {
+                    i: [
+                        self.tuning_word.eq(tuning_word),
+                        tuning_word_probation.eq(1)
+                    ] for i, tuning_word in enumerate(tuning_words)
+                })
+            )
+        ]
+
+        # Commands with parameters shift them in little-endian order, so
+        # that the last n bytes received are the top n bytes of payload.
+        group_bytes = 1 + (len(imux.arm_mask)+7)//8
+        payload = Signal(max(12, group_bytes + 4)*8)
+        payload_shift = Signal()
+        payload_reset = Signal()
+        payload_count = Signal(max=len(payload)//8)
+        self.sync += [
+            If(payload_shift,
+                payload.eq(Cat(payload[8:], self.rx_data)),
+                payload_count.eq(payload_count + 1)
+            ),
+            If(payload_reset,
+                payload_count.eq(0)
+            )
+        ]
+
+        # The readback window selects count samples, starting at start and
+        # stride addresses apart. It covers the whole insert when disabled.
+        window_load = Signal()
+        window_clear = Signal()
+        window_enable = Signal()
+        window_start = Signal.like(imux.address)
+        window_count = Signal.like(imux.address)
+        window_stride = Signal.like(imux.address)
+        window_remaining = Signal.like(imux.address)
+        self.sync += [
+            If(window_load,
+                window_start.eq(payload[-96:-64]),
+                window_count.eq(payload[-64:-32] - 1),
+                window_stride.eq(payload[-32:]),
+                window_enable.eq(payload[-64:-32] != 0)
+            ),
+            If(window_clear,
+                window_enable.eq(0)
+            )
+        ]
+
         next_address = Signal()
         reset_address = Signal()
         last_address = Signal()
         current_address = Signal.like(imux.address)
-        self.sync += current_address.eq(imux.address)
+        self.sync += [
+            current_address.eq(imux.address),
+            If(next_address,
+                window_remaining.eq(window_remaining - 1)
+            ),
+            If(reset_address,
+                window_remaining.eq(window_count)
+            )
+        ]
         self.comb += [
             imux.address.eq(current_address),
             If(next_address,
-                imux.address.eq(current_address + 1)
+                If(window_enable,
+                    imux.address.eq(current_address + window_stride)
+                ).Else(
+                    imux.address.eq(current_address + 1)
+                )
             ),
             If(reset_address,
-                imux.address.eq(0)
+                If(window_enable,
+                    imux.address.eq(window_start)
+                ).Else(
+                    imux.address.eq(0)
+                )
             ),
-            last_address.eq(current_address == imux.last_address)
+            If(window_enable,
+                last_address.eq(window_remaining == 0)
+            ).Else(
+                last_address.eq(current_address == imux.last_address)
+            )
         ]
 
+        # Samples are loaded into a shift register and sent from its low
+        # byte. Loading a sample moves the address to the next one, so that
+        # it is available when the last byte has been sent.
         next_byte = Signal()
-        reset_byte = Signal()
+        load_sample = Signal()
         last_byte = Signal()
+        last_sample = Signal()
         current_byte = Signal.like(imux.last_byte)
-        data = Signal(8)
-        nbytes = (len(imux.data)+7)//8
+        data = Signal(len(imux.data))
+        if len(data) > 8:
+            self.sync += If(next_byte, data.eq(data[8:]))
         self.sync += [
             If(next_byte,
-                Case(current_byte, {
-                    i: data.eq(imux.data[((i+1)*8):]) for i in range(nbytes-1)
-                }),
                 current_byte.eq(current_byte + 1)
             ),
-            If(reset_byte,
+            If(load_sample,
                 data.eq(imux.data),
-                current_byte.eq(0)
+                current_byte.eq(0),
+                last_sample.eq(last_address)
+            )
+        ]
+        self.comb += [
+            If(load_sample & ~last_address,
+                next_address.eq(1)
+            ),
+            last_byte.eq(current_byte == imux.last_byte)
+        ]
+
+        # Compressed readback: each sample is predicted as the previous
+        # sample plus the last delta. Runs of correctly predicted samples
+        # are sent as a single byte 0x80|(n-1), other samples as 0x00
+        # followed by the sample bytes.
+        compress_reset = Signal()
+        compress_literal = Signal()
+        compress_match = Signal()
+        run_length = Signal(max=129)
+        run_next = Signal()
+        run_reset = Signal()
+        run_final = Signal()
+        if compression:
+            previous = Signal(len(imux.data))
+            delta = Signal(len(imux.data))
+            prediction = Signal(len(imux.data))
+            self.comb += [
+                prediction.eq(previous + delta),
+                compress_match.eq((imux.data == prediction) & (run_length != 128))
+            ]
+            self.sync += [
+                If(compress_reset,
+                    previous.eq(0),
+                    delta.eq(0)
+                ),
+                If(run_next,
+                    previous.eq(imux.data)
+                ),
+                If(compress_literal,
+                    previous.eq(imux.data),
+                    delta.eq(imux.data - previous)
+                )
+            ]
+        self.sync += [
+            If(run_next,
+                run_length.eq(run_length + 1)
+            ),
+            If(run_reset,
+                run_length.eq(0),
+                run_final.eq(0)
+            ),
+            If(run_next & last_address,
+                run_final.eq(1)
+            )
+        ]
+
+        # Checked readback sends a CRC-16 of the data after every chunk of
+        # samples and after the last one, least significant byte first. A
+        # chunk that fails the check is sent again by reading it back through
+        # a window. Checked group readback sends one after each insert.
+        crc = Signal(16)
+        crc_reset = Signal()
+        crc_update = Signal()
+        crc_high = Signal()
+        crc_next = Signal()
+        chunk_load = Signal()
+        chunk_next = Signal()
+        chunk_size = Signal(16)
+        chunk_remaining = Signal(16)
+        self.sync += [
+            If(crc_reset,
+                crc.eq(0xffff),
+                crc_high.eq(0)
+            ).Elif(crc_update,
+                crc.eq(crc16_update(crc, self.tx_data))
+            ),
+            If(crc_next,
+                crc_high.eq(1)
+            ),
+            If(chunk_load,
+                chunk_size.eq(payload[-16:] - 1),
+                chunk_remaining.eq(payload[-16:] - 1)
+            ).Elif(chunk_next,
+                If(chunk_remaining == 0,
+                    chunk_remaining.eq(chunk_size)
+                ).Else(
+                    chunk_remaining.eq(chunk_remaining - 1)
+                )
             )
         ]
-        self.comb += last_byte.eq(current_byte == imux.last_byte)
 
+        mode_load = Signal()
+        compress = Signal()
+        snapshot = Signal()
+        sequence = Signal()
+        group_wait = Signal()
+        stream = Signal()
+        checked = Signal()
+        checked_group = Signal()
+        self.sync += If(mode_load,
+            compress.eq(self.rx_data == 0x06),
+            snapshot.eq(self.rx_data == 0x07),
+            sequence.eq((self.rx_data == 0x07) | (self.rx_data == 0x0d) |
+                        (self.rx_data == 0x0e) | (self.rx_data == 0x13)),
+            group_wait.eq(self.rx_data == 0x0c),
+            stream.eq(self.rx_data == 0x0e),
+            checked.eq(self.rx_data == 0x0f),
+            checked_group.eq(self.rx_data == 0x13)
+        )
+
+        # Sequential readbacks reset the selection and go through all
+        # inserts, then restore the selection made by the host.
         imux_sel_load = Signal()
+        imux_sel_reset = Signal()
+        imux_sel_next = Signal()
+        imux_sel_restore = Signal()
         if hasattr(imux, "sel"):
-            self.sync += If(imux_sel_load, imux.sel.eq(self.rx_data))
+            saved_sel = Signal.like(imux.sel)
+            self.sync += [
+                If(imux_sel_load, imux.sel.eq(self.rx_data)),
+                If(imux_sel_reset,
+                    imux.sel.eq(0),
+                    saved_sel.eq(imux.sel)
+                ),
+                If(imux_sel_next, imux.sel.eq(imux.sel + 1)),
+                If(imux_sel_restore, imux.sel.eq(saved_sel))
+            ]
+        snapshot_group_load = Signal()
+        self.sync += If(snapshot_group_load, imux.snapshot_group.eq(self.rx_data))
+
+        # The group command has a flags byte (bit 0: cross-trigger) followed
+        # by the insert mask.
+        group_load = Signal()
+        group_payload = payload[-group_bytes*8:]
+        self.sync += If(group_load,
+            imux.cross_trigger.eq(group_payload[0]),
+            imux.arm_mask.eq(group_payload[8:])
+        )
+
+        # Streaming arms the inserts of the group mask every interval cycles
+        # and sends their values in frames of 0xa5, a 16-bit sequence number
+        # and the samples, until any byte is received. The sequence number
+        # counts intervals, so that intervals that elapse while a frame is
+        # still being sent show up as gaps.
+        stream_load = Signal()
+        stream_take = Signal()
+        stream_interval = Signal(32)
+        stream_counter = Signal(32)
+        stream_pending = Signal()
+        stream_count = Signal(16)
+        stream_stop = Signal()
+        stream_header = Signal(24)
+        stream_header_next = Signal()
+        stream_header_byte = Signal(max=3)
+        self.sync += [
+            If(stream_counter == 0,
+                stream_counter.eq(stream_interval - 1),
+                stream_pending.eq(1),
+                stream_count.eq(stream_count + 1)
+            ).Else(
+                stream_counter.eq(stream_counter - 1)
+            ),
+            If(stream_take,
+                stream_header.eq(Cat(C(0xa5, 8), stream_count - 1)),
+                stream_header_byte.eq(0),
+                If(stream_counter != 0,
+                    stream_pending.eq(0)
+                )
+            ),
+            If(stream_header_next,
+                stream_header.eq(stream_header[8:]),
+                stream_header_byte.eq(stream_header_byte + 1)
+            ),
+            If(self.rx_stb,
+                stream_stop.eq(1)
+            ),
+            If(stream_load,
+                stream_interval.eq(payload[-(group_bytes + 4)*8:-group_bytes*8]),
+                stream_counter.eq(0),
+                stream_pending.eq(0),
+                stream_count.eq(0),
+                stream_stop.eq(0)
+            )
+        ]
+
+        # The trigger command has the number of register bytes, followed by
+        # the registers, which are shifted into the selected insert and
+        # committed together.
+        trigger_length_load = Signal()
+        trigger_remaining = Signal(8)
+        self.comb += imux.trigger_data.eq(self.rx_data)
+        self.sync += [
+            If(imux.trigger_stb,
+                trigger_remaining.eq(trigger_remaining - 1)
+            ),
+            If(trigger_length_load,
+                trigger_remaining.eq(self.rx_data)
+            )
+        ]
+
+        self.comb += imux.decimation.eq(payload[-32:])
+
+        # Outputs of a pipelined insert mux settle some cycles after a change.
+        settled = Signal()
+        if imux.latency:
+            settle_counter = Signal(max=imux.latency+1)
+            self.sync += If(
+                    (imux.address != current_address) |
+                    imux_sel_load | imux_sel_reset | imux_sel_next | imux_sel_restore |
+                    imux.arm | imux.snapshot_arm | imux.arm_group | group_load,
+                settle_counter.eq(imux.latency)
+            ).Elif(~settled,
+                settle_counter.eq(settle_counter - 1)
+            )
+            self.comb += settled.eq(settle_counter == 0)
+        else:
+            self.comb += settled.eq(1)
+
+        # Sequential readback of several inserts, either of a snapshot or of
+        # the inserts of the last group arm.
+        readback_match = Signal()
+        self.comb += If(snapshot,
+            readback_match.eq(imux.snapshot_match)
+        ).Else(
+            readback_match.eq(imux.group_match)
+        )
+        self.comb += window_clear.eq(imux_sel_load | imux_sel_reset)
 
         fsm = ResetInserter()(FSM())
         self.submodules += fsm
@@ -175,18 +620,40 @@ class SerialProtocolEngine(Module):
                 )
             )
         )
+        commands = {
+            0x00: NextState("SEND_CONFIG"),
+            0x01: NextState("SET_SEL"),
+            0x02: imux.arm.eq(1),
+            0x03: NextState("SEND_PENDING"),
+            0x04: NextState("LOAD_SAMPLE"),
+            0x05: NextState("SET_BAUDRATE"),
+            0x07: NextState("SNAPSHOT"),
+            0x08: [imux.arm.eq(1), NextState("ARM_WAIT")],
+            0x09: NextState("SEND_CONFIG_HASH"),
+            0x0a: NextState("SET_WINDOW"),
+            0x0b: NextState("SET_GROUP"),
+            0x0c: NextState("SET_GROUP"),
+            0x0d: [imux_sel_reset.eq(1), NextState("SEND_INSERT")],
+            0x0e: NextState("SET_STREAM"),
+            0x0f: NextState("SET_CHUNK"),
+            0x10: NextState("SET_TRIGGER_LENGTH"),
+            0x11: NextState("SET_DECIMATION"),
+            0x12: [tuning_word_confirm.eq(1), NextState("MAGIC1")],
+            0x13: [imux_sel_reset.eq(1), NextState("SEND_INSERT")]
+        }
+        if compression:
+            commands[0x06] = NextState("COMPRESS")
         fsm.act("COMMAND",
             config_rom.reset.eq(1),
+            config_hash_rom.reset.eq(1),
             reset_address.eq(1),
-            reset_byte.eq(1),
+            compress_reset.eq(1),
+            run_reset.eq(1),
+            payload_reset.eq(1),
+            crc_reset.eq(1),
             If(self.rx_stb,
-                Case(self.rx_data, {
-                    0x00: NextState("SEND_CONFIG"),
-                    0x01: NextState("SET_SEL"),
-                    0x02: imux.arm.eq(1),
-                    0x03: NextState("SEND_PENDING"),
-                    0x04: NextState("SEND_DATA")
-                })
+                mode_load.eq(1),
+                Case(self.rx_data, commands)
             )
         )
         fsm.act("SEND_CONFIG",
@@ -197,45 +664,337 @@ class SerialProtocolEngine(Module):
                 If(config_rom.last, NextState("MAGIC1"))
             )
         )
+        fsm.act("SEND_CONFIG_HASH",
+            self.tx_stb.eq(1),
+            self.tx_data.eq(config_hash_rom.data),
+            If(self.tx_ack,
+                config_hash_rom.next.eq(1),
+                If(config_hash_rom.last, NextState("MAGIC1"))
+            )
+        )
         fsm.act("SET_SEL",
             If(self.rx_stb,
                 imux_sel_load.eq(1),
                 NextState("MAGIC1")
             )
         )
-        fsm.act("SEND_PENDING",
+        fsm.act("SET_WINDOW",
+            If(self.rx_stb,
+                payload_shift.eq(1),
+                If(payload_count == 11,
+                    NextState("LOAD_WINDOW")
+                )
+            )
+        )
+        fsm.act("LOAD_WINDOW",
+            window_load.eq(1),
+            NextState("MAGIC1")
+        )
+        fsm.act("SET_GROUP",
+            If(self.rx_stb,
+                payload_shift.eq(1),
+                If(payload_count == group_bytes-1,
+                    NextState("LOAD_GROUP")
+                )
+            )
+        )
+        fsm.act("LOAD_GROUP",
+            group_load.eq(1),
+            NextState("ARM_GROUP")
+        )
+        fsm.act("ARM_GROUP",
+            imux.arm_group.eq(1),
+            If(group_wait,
+                NextState("ARM_WAIT")
+            ).Else(
+                NextState("MAGIC1")
+            )
+        )
+        fsm.act("SET_STREAM",
+            If(self.rx_stb,
+                payload_shift.eq(1),
+                If(payload_count == group_bytes + 3,
+                    NextState("LOAD_STREAM")
+                )
+            )
+        )
+        fsm.act("LOAD_STREAM",
+            group_load.eq(1),
+            stream_load.eq(1),
+            NextState("STREAM_WAIT")
+        )
+        fsm.act("STREAM_WAIT",
+            keepalive.eq(1),
+            If(stream_stop,
+                NextState("MAGIC1")
+            ).Elif(stream_pending,
+                stream_take.eq(1),
+                imux.arm_group.eq(1),
+                imux_sel_reset.eq(1),
+                NextState("STREAM_CAPTURE")
+            )
+        )
+        fsm.act("STREAM_CAPTURE",
+            If(settled & ~imux.group_pending,
+                NextState("STREAM_HEADER")
+            )
+        )
+        fsm.act("STREAM_HEADER",
             self.tx_stb.eq(1),
+            self.tx_data.eq(stream_header[:8]),
+            If(self.tx_ack,
+                stream_header_next.eq(1),
+                If(stream_header_byte == 2,
+                    NextState("SEND_INSERT")
+                )
+            )
+        )
+        fsm.act("SET_CHUNK",
+            If(self.rx_stb,
+                payload_shift.eq(1),
+                If(payload_count == 1,
+                    NextState("LOAD_CHUNK")
+                )
+            )
+        )
+        fsm.act("LOAD_CHUNK",
+            chunk_load.eq(1),
+            NextState("LOAD_SAMPLE")
+        )
+        fsm.act("SET_TRIGGER_LENGTH",
+            If(self.rx_stb,
+                trigger_length_load.eq(1),
+                NextState("SET_TRIGGER")
+            )
+        )
+        fsm.act("SET_TRIGGER",
+            If(trigger_remaining == 0,
+                imux.trigger_commit.eq(1),
+                NextState("MAGIC1")
+            ).Elif(self.rx_stb,
+                imux.trigger_stb.eq(1)
+            )
+        )
+        fsm.act("SET_DECIMATION",
+            If(self.rx_stb,
+                payload_shift.eq(1),
+                If(payload_count == 3,
+                    NextState("LOAD_DECIMATION")
+                )
+            )
+        )
+        fsm.act("LOAD_DECIMATION",
+            imux.decimation_load.eq(1),
+            NextState("MAGIC1")
+        )
+        fsm.act("SET_BAUDRATE",
+            If(self.rx_stb,
+                tuning_word_load.eq(1),
+                NextState("MAGIC1")
+            )
+        )
+        fsm.act("SNAPSHOT",
+            If(self.rx_stb,
+                snapshot_group_load.eq(1),
+                NextState("SNAPSHOT_ARM")
+            )
+        )
+        fsm.act("SNAPSHOT_ARM",
+            imux.snapshot_arm.eq(1),
+            imux_sel_reset.eq(1),
+            NextState("SNAPSHOT_WAIT")
+        )
+        fsm.act("SNAPSHOT_WAIT",
+            If(~imux.snapshot_pending,
+                NextState("SEND_INSERT")
+            )
+        )
+        # Memories have a cycle of read latency, so the first sample is only
+        # loaded in LOAD_SAMPLE.
+        fsm.act("SEND_INSERT",
+            reset_address.eq(1),
+            If(settled,
+                If(readback_match,
+                    NextState("LOAD_SAMPLE")
+                ).Else(
+                    NextState("NEXT_INSERT")
+                )
+            )
+        )
+        fsm.act("NEXT_INSERT",
+            If(imux.last_sel,
+                imux_sel_restore.eq(1),
+                If(stream,
+                    NextState("STREAM_WAIT")
+                ).Else(
+                    NextState("MAGIC1")
+                )
+            ).Else(
+                imux_sel_next.eq(1),
+                NextState("SEND_INSERT")
+            )
+        )
+        # Waiting for a trigger can take arbitrarily long, so the timeout is
+        # suspended. The host aborts the wait by sending any byte; a magic
+        # sequence is recognized directly.
+        fsm.act("ARM_WAIT",
+            keepalive.eq(1),
+            If(self.rx_stb,
+                If(self.rx_data == 0x1a,
+                    NextState("MAGIC2")
+                ).Else(
+                    NextState("MAGIC1")
+                )
+            ).Elif(settled & ~Mux(group_wait, imux.group_pending, imux.pending),
+                NextState("SEND_DONE")
+            )
+        )
+        fsm.act("SEND_DONE",
+            self.tx_stb.eq(1),
+            self.tx_data.eq(0x01),
+            If(self.tx_ack, NextState("MAGIC1"))
+        )
+        fsm.act("SEND_PENDING",
+            self.tx_stb.eq(settled),
             self.tx_data.eq(imux.pending),
             If(self.tx_ack, NextState("MAGIC1"))
         )
+        next_sample = If(settled,
+            load_sample.eq(1)
+        ).Else(
+            NextState("LOAD_SAMPLE")
+        )
+        if compression:
+            next_sample = If(compress,
+                NextState("COMPRESS")
+            ).Else(
+                next_sample
+            )
         fsm.act("SEND_DATA",
             self.tx_stb.eq(1),
-            self.tx_data.eq(data),
+            self.tx_data.eq(data[:8]),
             If(self.tx_ack,
                 next_byte.eq(1),
+                crc_update.eq(1),
                 If(last_byte,
-                    next_address.eq(1),
-                    If(last_address,
-                        NextState("MAGIC1")
+                    chunk_next.eq(1),
+                    If((checked & ((chunk_remaining == 0) | last_sample)) |
+                       (checked_group & last_sample),
+                        NextState("SEND_CRC")
+                    ).Elif(last_sample,
+                        If(sequence,
+                            NextState("NEXT_INSERT")
+                        ).Else(
+                            NextState("MAGIC1")
+                        )
                     ).Else(
-                        NextState("RESET_BYTE")
+                        next_sample
                     )
                 )
             )
         )
-        fsm.act("RESET_BYTE",
-            reset_byte.eq(1),
-            NextState("SEND_DATA")
+        fsm.act("SEND_CRC",
+            self.tx_stb.eq(1),
+            self.tx_data.eq(Mux(crc_high, crc[8:], crc[:8])),
+            If(self.tx_ack,
+                If(crc_high,
+                    crc_reset.eq(1),
+                    If(last_sample,
+                        If(sequence,
+                            NextState("NEXT_INSERT")
+                        ).Else(
+                            NextState("MAGIC1")
+                        )
+                    ).Else(
+                        NextState("LOAD_SAMPLE")
+                    )
+                ).Else(
+                    crc_next.eq(1)
+                )
+            )
+        )
+        fsm.act("LOAD_SAMPLE",
+            If(settled,
+                load_sample.eq(1),
+                NextState("SEND_DATA")
+            )
         )
+        if compression:
+            fsm.act("COMPRESS",
+                If(settled,
+                    If(compress_match,
+                        run_next.eq(1),
+                        If(last_address,
+                            NextState("SEND_RUN")
+                        ).Else(
+                            next_address.eq(1)
+                        )
+                    ).Elif(run_length != 0,
+                        NextState("SEND_RUN")
+                    ).Else(
+                        load_sample.eq(1),
+                        compress_literal.eq(1),
+                        NextState("SEND_LITERAL")
+                    )
+                )
+            )
+            fsm.act("SEND_RUN",
+                self.tx_stb.eq(1),
+                self.tx_data.eq(0x80 | (run_length - 1)),
+                If(self.tx_ack,
+                    run_reset.eq(1),
+                    If(run_final,
+                        NextState("MAGIC1")
+                    ).Else(
+                        NextState("COMPRESS")
+                    )
+                )
+            )
+            fsm.act("SEND_LITERAL",
+                self.tx_stb.eq(1),
+                self.tx_data.eq(0x00),
+                If(self.tx_ack,
+                    NextState("SEND_DATA")
+                )
+            )
 
 
 class Microscope(Module):
-    def __init__(self, serial_pads, sys_clk_freq, registry=None):
+    standard_baudrates = [115200, 230400, 460800, 921600,
+                          1000000, 1500000, 2000000, 3000000]
+
+    def __init__(self, serial_pads, sys_clk_freq, registry=None,
+                 baudrate=115200, baudrates=None, compression=False, mux_pipeline=0,
+                 phy=None):
         self.serial_pads = serial_pads
         self.sys_clk_freq = sys_clk_freq
         if registry is None:
             registry = global_registry
         self.registry = registry
+        # The protocol engine talks to the host through a byte stream PHY:
+        # rx_data/rx_stb for received bytes, and tx_data/tx_stb held until
+        # tx_ack for sent ones. By default, a UART is created on serial_pads.
+        # Other PHYs (such as spi.SPISlave) are passed as phy, and
+        # serial_pads is then unused.
+        self.phy = phy
+        if phy is None:
+            # The first entry is the rate the UART comes up at and falls back
+            # to. Further rates can be selected at runtime by the host. Keep
+            # at least 16 clock cycles per bit so that the receiver samples
+            # reliably.
+            if baudrates is None:
+                baudrates = [rate for rate in self.standard_baudrates
+                             if rate > baudrate and sys_clk_freq/rate >= 16]
+            self.baudrates = [baudrate] + [rate for rate in baudrates
+                                           if rate != baudrate]
+            if len(self.baudrates) > 256:
+                raise ValueError("Too many baud rates")
+        else:
+            self.baudrates = None
+        self.compression = compression
+        # Number of register stages of the insert multiplexer. Designs with
+        # many inserts need them to meet timing.
+        self.mux_pipeline = mux_pipeline
 
         self.clock_domains.cd_microscope = ClockDomain(reset_less=True)
         self.comb += self.cd_microscope.clk.eq(ClockSignal())
@@ -248,16 +1007,28 @@ class Microscope(Module):
         for insert in inserts:
             insert.create_insert_logic()
 
-        config_rom = ConfigROM(list(get_config_from_inserts(inserts)))
-        imux = InsertMux(inserts)
-        spe = SerialProtocolEngine(config_rom, imux, round(self.sys_clk_freq*50e-3))
-        uart = UART(self.serial_pads, round((115200/self.sys_clk_freq)*2**32))
-        self.submodules += config_rom, imux, spe, uart
+        config = get_config_from_inserts(inserts, self.baudrates, self.compression,
+                                         self.sys_clk_freq)
+        config_rom = ConfigROM(list(config))
+        config_hash_rom = ConfigROM(list(get_config_hash(config)))
+        imux = InsertMux(inserts, self.mux_pipeline)
+        if self.baudrates is None:
+            tuning_words = [0]
+        else:
+            tuning_words = [round((baudrate/self.sys_clk_freq)*2**32)
+                            for baudrate in self.baudrates]
+        spe = SerialProtocolEngine(config_rom, config_hash_rom, imux,
+                                   round(self.sys_clk_freq*50e-3),
+                                   tuning_words, self.compression)
+        phy = self.phy
+        if phy is None:
+            phy = UART(self.serial_pads, spe.tuning_word)
+        self.submodules += config_rom, config_hash_rom, imux, spe, phy
 
         self.comb += [
-            spe.rx_data.eq(uart.rx_data),
-            spe.rx_stb.eq(uart.rx_stb),
-            uart.tx_data.eq(spe.tx_data),
-            uart.tx_stb.eq(spe.tx_stb),
-            spe.tx_ack.eq(uart.tx_ack)
+            spe.rx_data.eq(phy.rx_data),
+            spe.rx_stb.eq(phy.rx_stb),
+            phy.tx_data.eq(spe.tx_data),
+            phy.tx_stb.eq(spe.tx_stb),
+            spe.tx_ack.eq(phy.tx_ack)
         ]
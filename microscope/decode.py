@@ -0,0 +1,75 @@
+import numpy
+
+
+__all__ = ["get_dtype", "decode_samples", "split_deltas", "expand_timeline",
+           "save_samples"]
+
+
+def get_dtype(width):
+    """Returns the NumPy dtype holding one sample of ``width`` bits, or
+    ``None`` if the samples are wider than 64 bits."""
+    word_len = (width+7)//8
+    for itemsize in 1, 2, 4, 8:
+        if word_len <= itemsize:
+            return numpy.dtype("<u{}".format(itemsize))
+    return None
+
+
+def decode_samples(data, width, wide="split"):
+    """Converts readback data into an array of samples.
+
+    Samples up to 64 bits use native unsigned integers. Wider samples are
+    split into 64-bit words (least significant first, one row per sample),
+    or converted to Python integers in an object array if ``wide`` is
+    ``"object"``.
+    """
+    word_len = (width+7)//8
+    raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, word_len)
+    dtype = get_dtype(width)
+    if dtype is None:
+        if wide == "object":
+            return numpy.array([int.from_bytes(sample.tobytes(), "little") for sample in raw],
+                               dtype=object)
+        elif wide != "split":
+            raise ValueError("Unknown wide sample representation: " + wide)
+        dtype = numpy.dtype("<u8")
+        itemsize = (word_len + 7)//8*8
+    else:
+        itemsize = dtype.itemsize
+    if itemsize != word_len:
+        padded = numpy.zeros((len(raw), itemsize), dtype=numpy.uint8)
+        padded[:, :word_len] = raw
+        raw = padded
+    samples = raw.view(dtype)
+    if samples.shape[1] == 1:
+        samples = samples.reshape(-1)
+    return samples
+
+
+def split_deltas(words, width):
+    """Splits decoded words of a storage-qualified buffer into sample values
+    (the low ``width`` bits) and cycle deltas."""
+    return words & (2**width - 1), words >> width
+
+
+def expand_timeline(times, values):
+    """Expands samples stored at increasing cycles ``times`` into one value
+    per cycle, starting at ``times[0]``. Each value is held until the next
+    stored sample."""
+    repeats = numpy.diff(times, append=times[-1] + 1)
+    return numpy.repeat(values, repeats)
+
+
+def save_samples(filename, samples, fmt="npy"):
+    """Writes samples into a ``.npy`` file, or into a headerless file of
+    little-endian words (``fmt="raw"``) that can be opened with
+    ``numpy.memmap``."""
+    if fmt == "npy":
+        with open(filename, "wb") as f:
+            numpy.save(f, samples)
+    elif fmt == "raw":
+        if samples.dtype == object:
+            raise ValueError("Object arrays cannot be written as raw data")
+        samples.tofile(filename)
+    else:
+        raise ValueError("Unknown format: " + fmt)
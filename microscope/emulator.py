@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+"""Software model of the Microscope serial protocol.
+
+The emulator serves a generated configuration and synthetic probe data,
+so that the client can be exercised without hardware. It is reachable
+through a pseudo-terminal or a TCP socket (``socket://`` URL in pyserial).
+"""
+
+import os
+import sys
+import time
+import math
+import socket
+import select
+import struct
+import argparse
+import hashlib
+
+import msgpack
+
+from microscope.microscope import crc16
+
+
+__all__ = ["EmulatedInsert", "EmulatedCounter", "EmulatedHistogram", "Emulator", "compress"]
+
+
+def compress(samples, width, word_len):
+    """Encodes samples the same way as the gateware compressor, which
+    computes its predictions with ``width`` bits."""
+    mask = 2**width - 1
+    previous = delta = 0
+    run_length = 0
+    r = bytearray()
+    for sample in samples:
+        if sample == (previous + delta) & mask and run_length != 128:
+            previous = sample
+            run_length += 1
+            continue
+        if run_length:
+            r.append(0x80 | (run_length - 1))
+            run_length = 0
+            if sample == (previous + delta) & mask:
+                previous = sample
+                run_length += 1
+                continue
+        delta = (sample - previous) & mask
+        previous = sample
+        r.append(0x00)
+        r += sample.to_bytes(word_len, "little")
+    if run_length:
+        r.append(0x80 | (run_length - 1))
+    return bytes(r)
+
+
+class EmulatedInsert:
+    """An emulated insert. Inserts with a depth of 1 behave like
+    ``ProbeSingle``, deeper ones like ``ProbeBuffer``. ``source(n, count)``
+    returns the ``count`` samples of the ``n``-th capture, by default a
+    counter. Captures complete ``trigger_delay`` seconds after arming.
+    With ``sequence_width``, the insert has a programmable trigger, whose
+    registers are kept in ``trigger_registers`` but not evaluated. With
+    ``decimation_width``, the decimation factor set by the host is kept in
+    ``decimation``, and the samples are not affected. ``pretrigger`` and
+    ``double_buffered`` only set the corresponding options."""
+    def __init__(self, group, name, width, depth=1, source=None, trigger_delay=0.0,
+                 sequence_width=None, pretrigger=0, decimation_width=None,
+                 double_buffered=False):
+        self.group = group
+        self.name = name
+        self.width = width
+        self.depth = depth
+        if source is None:
+            source = self.counter
+        self.source = source
+        self.trigger_delay = trigger_delay
+        self.options = {}
+        if sequence_width is not None:
+            self.options["trg"] = sequence_width
+        if pretrigger:
+            self.options["pre"] = pretrigger
+        if decimation_width is not None:
+            self.options["dec"] = decimation_width
+        if double_buffered:
+            self.options["dbl"] = True
+        self.trigger_registers = None
+        self.decimation = 1
+
+        self.captures = 0
+        self.armed_at = None
+        self.samples = [0]*depth
+
+    def counter(self, n, count):
+        return [(n*1000 + i) & (2**self.width - 1) for i in range(count)]
+
+    def arm(self, now):
+        self.armed_at = now
+        self.samples = self.source(self.captures, self.depth)
+        self.captures += 1
+
+    def pending(self, now):
+        return self.armed_at is not None and now - self.armed_at < self.trigger_delay
+
+
+class EmulatedCounter(EmulatedInsert):
+    """An emulated ``ProbeCounter``, whose condition holds during a fraction
+    ``duty`` of the cycles of a ``clk_freq`` clock."""
+    def __init__(self, group, name, width=32, duty=0.25, clk_freq=100e6):
+        EmulatedInsert.__init__(self, group, name, 2*width)
+        self.counter_width = width
+        self.duty = duty
+        self.clk_freq = clk_freq
+        self.options = {"cnt": width, "clk": round(clk_freq)}
+        self.cleared_at = time.monotonic()
+
+    def arm(self, now):
+        cycles = min(int((now - self.cleared_at)*self.clk_freq), 2**self.counter_width - 1)
+        events = int(cycles*self.duty)
+        self.cleared_at = now
+        self.samples = [events | (cycles << self.counter_width)]
+        self.captures += 1
+
+
+class EmulatedHistogram(EmulatedInsert):
+    """An emulated ``ProbeHistogram`` with a set ``duration`` in cycles of a
+    ``clk_freq`` clock, of a latency with an exponential distribution of
+    mean ``mean`` sampled every cycle."""
+    def __init__(self, group, name, bins=64, bin_width=4, counter_width=32, mean=20.0,
+                 duration=10**7, clk_freq=100e6):
+        EmulatedInsert.__init__(self, group, name, counter_width, bins,
+                                trigger_delay=duration/clk_freq)
+        self.bin_width = bin_width
+        self.mean = mean
+        self.duration = duration
+        self.options = {"bin": bin_width, "dur": duration}
+
+    def arm(self, now):
+        EmulatedInsert.arm(self, now)
+        # Fraction of the distribution below the edge of each bin.
+        edges = [1 - math.exp(-i*self.bin_width/self.mean) for i in range(self.depth)] + [1]
+        self.samples = [min(int(self.duration*(edges[i+1] - edges[i])), 2**self.width - 1)
+                        for i in range(self.depth)]
+
+
+class Emulator:
+    """Byte-level model of the protocol engine. Data received from the host
+    is passed to ``receive``; replies are taken with ``transmit``. ``poll``
+    advances time-dependent state and should be called regularly."""
+    magic = b"\x1a\xe5\x52\x9c"
+
+    def __init__(self, inserts, baudrates=(115200,), compression=False,
+                 timeout=50e-3, clk_freq=100e6):
+        self.inserts = inserts
+        self.baudrates = list(baudrates)
+        self.compression = compression
+        self.timeout = timeout
+        self.clk_freq = clk_freq
+
+        self.config = self.get_config()
+        self.config_hash = hashlib.sha256(self.config).digest()[:16]
+        self.max_width = max(insert.width for insert in inserts)
+
+        self.output = bytearray()
+        self.baudrate_index = 0
+        self.baudrate_probation = False
+        self.sel = 0
+        self.window = None
+        self.arm_mask = []
+        self.reset()
+        self.last_activity = time.monotonic()
+
+    def get_config(self):
+        groups = []
+        for insert in self.inserts:
+            if insert.group not in groups:
+                groups.append(insert.group)
+        config = {
+            "grp": groups,
+            "ins": [[groups.index(insert.group), insert.name, insert.width, insert.depth]
+                    + ([insert.options] if insert.options else [])
+                    for insert in self.inserts],
+            "crc": True,
+            "bdr": self.baudrates
+        }
+        if self.compression:
+            config["cmp"] = True
+        config["clk"] = round(self.clk_freq)
+        return msgpack.packb(config, use_bin_type=True)
+
+    @property
+    def baudrate(self):
+        return self.baudrates[self.baudrate_index]
+
+    def reset(self):
+        self.magic_index = 0
+        self.parameter = None
+        self.parameter_len = 0
+        self.handler = None
+        self.wait = None
+        self.stream = None
+
+    def receive(self, data, now=None):
+        if now is None:
+            now = time.monotonic()
+        for byte in data:
+            self.last_activity = now
+            if self.wait is not None:
+                # Any byte aborts a wait, and may start the next command.
+                self.wait = None
+                self.magic_index = 1 if byte == self.magic[0] else 0
+            elif self.stream is not None:
+                # The byte that stops streaming is consumed.
+                self.stream = None
+            elif self.handler is not None:
+                self.parameter.append(byte)
+                if len(self.parameter) == self.parameter_len:
+                    handler, parameter = self.handler, bytes(self.parameter)
+                    self.reset()
+                    handler(parameter, now)
+            elif self.magic_index < len(self.magic):
+                if byte == self.magic[self.magic_index]:
+                    self.magic_index += 1
+                else:
+                    self.magic_index = 0
+            else:
+                self.magic_index = 0
+                self.command(byte, now)
+
+    def expect(self, length, handler):
+        self.parameter = bytearray()
+        self.parameter_len = length
+        self.handler = handler
+
+    def poll(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.wait is not None:
+            if not any(insert.pending(now) for insert in self.wait):
+                self.wait = None
+                self.send(b"\x01", now)
+        elif self.stream is not None:
+            self.poll_stream(now)
+        elif now - self.last_activity > self.timeout:
+            self.last_activity = now
+            self.reset()
+            if self.baudrate_probation:
+                self.baudrate_index = 0
+                self.baudrate_probation = False
+
+    def send(self, data, now):
+        self.last_activity = now
+        self.output += data
+
+    def transmit(self, max_len=None):
+        if max_len is None:
+            max_len = len(self.output)
+        data = bytes(self.output[:max_len])
+        del self.output[:max_len]
+        return data
+
+    def command(self, command, now):
+        if command == 0x00:
+            self.send(self.config, now)
+        elif command == 0x01:
+            self.expect(1, self.select)
+        elif command == 0x02:
+            self.arm_selected(now)
+        elif command == 0x03:
+            self.send(struct.pack("B", self.selected.pending(now)), now)
+        elif command == 0x04:
+            self.send(self.readback(self.selected), now)
+        elif command == 0x05:
+            self.expect(1, self.set_baudrate)
+        elif command == 0x06 and self.compression:
+            insert = self.selected
+            self.send(compress(self.get_samples(insert), self.max_width,
+                               (insert.width+7)//8), now)
+        elif command == 0x07:
+            self.expect(1, self.snapshot)
+        elif command == 0x08:
+            self.arm_selected(now)
+            self.wait = [self.selected]
+        elif command == 0x09:
+            self.send(self.config_hash, now)
+        elif command == 0x0a:
+            self.expect(12, self.set_window)
+        elif command in (0x0b, 0x0c):
+            wait = command == 0x0c
+            self.expect(1 + (len(self.inserts)+7)//8,
+                        lambda parameter, now: self.arm_group(parameter, now, wait))
+        elif command == 0x0d:
+            self.window = None
+            self.send(b"".join(self.readback(self.inserts[n]) for n in self.arm_mask), now)
+        elif command == 0x0e:
+            self.expect(5 + (len(self.inserts)+7)//8, self.start_stream)
+        elif command == 0x0f:
+            self.expect(2, self.checked_readback)
+        elif command == 0x10:
+            self.expect(1, self.set_trigger_length)
+        elif command == 0x11:
+            self.expect(4, self.set_decimation)
+        elif command == 0x12:
+            self.baudrate_probation = False
+        elif command == 0x13:
+            self.window = None
+            for n in self.arm_mask:
+                data = self.readback(self.inserts[n])
+                self.send(data + struct.pack("<H", crc16(data)), now)
+
+    @property
+    def selected(self):
+        return self.inserts[self.sel]
+
+    def select(self, parameter, now):
+        self.sel = min(parameter[0], len(self.inserts) - 1)
+        self.window = None
+
+    def arm_selected(self, now):
+        self.selected.arm(now)
+
+    def set_trigger_length(self, parameter, now):
+        if parameter[0]:
+            self.expect(parameter[0], self.set_trigger)
+        else:
+            self.set_trigger(b"", now)
+
+    def set_trigger(self, parameter, now):
+        self.selected.trigger_registers = parameter
+
+    def set_decimation(self, parameter, now):
+        self.selected.decimation = struct.unpack("<I", parameter)[0] + 1
+
+    def set_baudrate(self, parameter, now):
+        if parameter[0] < len(self.baudrates):
+            self.baudrate_index = parameter[0]
+            self.baudrate_probation = True
+
+    def set_window(self, parameter, now):
+        start, count, stride = struct.unpack("<III", parameter)
+        if count:
+            self.window = start, count, stride
+        else:
+            self.window = None
+
+    def snapshot(self, parameter, now):
+        group = parameter[0]
+        groups = msgpack.unpackb(self.config)["grp"]
+        singles = [insert for insert in self.inserts
+                   if insert.depth == 1 and not isinstance(insert, EmulatedCounter)
+                   and (group == 0xff or group == groups.index(insert.group))]
+        for insert in singles:
+            insert.arm(now)
+        self.window = None
+        self.send(b"".join(self.readback(insert) for insert in singles), now)
+
+    def arm_group(self, parameter, now, wait):
+        mask = int.from_bytes(parameter[1:], "little")
+        self.arm_mask = [n for n in range(len(self.inserts)) if mask & (1 << n)]
+        for n in self.arm_mask:
+            self.inserts[n].arm(now)
+        if wait:
+            self.wait = [self.inserts[n] for n in self.arm_mask]
+
+    def checked_readback(self, parameter, now):
+        chunk = struct.unpack("<H", parameter)[0] or 0x10000
+        insert = self.selected
+        word_len = (insert.width+7)//8
+        data = self.readback(insert)
+        for i in range(0, len(data), chunk*word_len):
+            chunk_data = data[i:i+chunk*word_len]
+            self.send(chunk_data + struct.pack("<H", crc16(chunk_data)), now)
+
+    def start_stream(self, parameter, now):
+        interval = struct.unpack("<I", parameter[:4])[0]
+        self.arm_group(parameter[4:], now, False)
+        self.window = None
+        # Start time, interval in seconds and number of the last tick sent.
+        self.stream = now, (interval or 2**32)/self.clk_freq, None
+
+    def poll_stream(self, now):
+        start, interval, last_tick = self.stream
+        tick = int((now - start)/interval)
+        # Like the gateware, a frame is only started once the previous one
+        # has been sent, and intervals elapsed in the meantime are dropped.
+        if tick == last_tick or self.output:
+            return
+        self.stream = start, interval, tick
+        for n in self.arm_mask:
+            self.inserts[n].arm(now)
+        self.send(struct.pack("<BH", 0xa5, tick & 0xffff) +
+                  b"".join(self.readback(self.inserts[n]) for n in self.arm_mask), now)
+
+    def get_samples(self, insert):
+        if self.window is None:
+            return insert.samples
+        start, count, stride = self.window
+        return [insert.samples[(start + i*stride) % insert.depth] for i in range(count)]
+
+    def readback(self, insert):
+        word_len = (insert.width+7)//8
+        return b"".join(sample.to_bytes(word_len, "little")
+                        for sample in self.get_samples(insert))
+
+    def serve(self, fileno, read, write, throttle=False):
+        """Serves a connection until it is closed. With ``throttle``, the
+        output rate is limited to the current baud rate."""
+        credit = 0.0
+        last = time.monotonic()
+        while True:
+            readable, _, _ = select.select([fileno], [], [], 1e-3)
+            now = time.monotonic()
+            if readable:
+                try:
+                    data = read(4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                self.receive(data, now)
+            self.poll(now)
+            if throttle:
+                credit = min(credit + (now - last)*self.baudrate/10, 64)
+                data = self.transmit(int(credit))
+                credit -= len(data)
+            else:
+                data = self.transmit()
+            last = now
+            if data:
+                try:
+                    write(data)
+                except OSError:
+                    return
+
+    def serve_pty(self, throttle=False, ready=None):
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        port = os.ttyname(slave)
+        if ready is not None:
+            ready(port)
+        try:
+            self.serve(master, lambda n: os.read(master, n),
+                       lambda data: os.write(master, data), throttle)
+        finally:
+            os.close(master)
+            os.close(slave)
+
+    def serve_tcp(self, host="localhost", port=0, throttle=False, ready=None):
+        """Serves connections one after the other. ``ready`` is called with
+        the pyserial URL once the server is listening."""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, port))
+            server.listen(1)
+            if ready is not None:
+                ready("socket://{}:{}".format(*server.getsockname()))
+            while True:
+                connection, _ = server.accept()
+                with connection:
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.reset()
+                    self.serve(connection.fileno(), connection.recv, connection.sendall,
+                               throttle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microscope device emulator")
+    parser.add_argument("--tcp", metavar="PORT", type=int, default=None,
+                        help="listen on this TCP port instead of creating a pseudo-terminal")
+    parser.add_argument("--singles", type=int, default=4,
+                        help="number of single-value inserts (default: %(default)s)")
+    parser.add_argument("--buffers", type=int, default=2,
+                        help="number of buffering inserts (default: %(default)s)")
+    parser.add_argument("--counters", type=int, default=2,
+                        help="number of event counters (default: %(default)s)")
+    parser.add_argument("--histograms", type=int, default=1,
+                        help="number of histograms (default: %(default)s)")
+    parser.add_argument("--width", type=int, default=32,
+                        help="insert width (default: %(default)s)")
+    parser.add_argument("--depth", type=int, default=256,
+                        help="buffer depth (default: %(default)s)")
+    parser.add_argument("--trigger-delay", type=float, default=0.0,
+                        help="seconds between arming and capture of buffers (default: %(default)s)")
+    parser.add_argument("--baudrate", type=int, action="append", default=None,
+                        help="supported baud rate, the first one is the default (repeatable)")
+    parser.add_argument("--compression", action="store_true",
+                        help="support compressed readback")
+    parser.add_argument("--throttle", action="store_true",
+                        help="limit the output rate to the emulated baud rate")
+    args = parser.parse_args()
+
+    inserts = []
+    for i in range(args.singles):
+        inserts.append(EmulatedInsert("singles", "s{}".format(i), args.width))
+    for i in range(args.counters):
+        inserts.append(EmulatedCounter("counters", "c{}".format(i), duty=1/(i + 2)))
+    for i in range(args.histograms):
+        inserts.append(EmulatedHistogram("histograms", "h{}".format(i), mean=20.0*(i + 1)))
+    for i in range(args.buffers):
+        inserts.append(EmulatedInsert("buffers", "b{}".format(i), args.width, args.depth,
+                                      trigger_delay=args.trigger_delay, sequence_width=16,
+                                      decimation_width=16))
+    if not inserts:
+        raise SystemExit("No inserts")
+    baudrates = args.baudrate
+    if baudrates is None:
+        baudrates = [115200, 1000000, 3000000]
+    emulator = Emulator(inserts, baudrates, args.compression)
+
+    def ready(url):
+        print("serving on " + url, file=sys.stderr)
+    try:
+        if args.tcp is None:
+            emulator.serve_pty(args.throttle, ready)
+        else:
+            emulator.serve_tcp(port=args.tcp, throttle=args.throttle, ready=ready)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -12,5 +12,13 @@ def add_probe_single(*args, **kwargs):
     return ProbeSingle(registry, *args, **kwargs)
 
 
+def add_probe_counter(*args, **kwargs):
+    return ProbeCounter(registry, *args, **kwargs)
+
+
 def add_probe_buffer(*args, **kwargs):
     return ProbeBuffer(registry, *args, **kwargs)
+
+
+def add_probe_histogram(*args, **kwargs):
+    return ProbeHistogram(registry, *args, **kwargs)
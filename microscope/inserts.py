@@ -1,8 +1,14 @@
+from functools import reduce
+from operator import or_
+
 from migen import *
 from migen.genlib.cdc import PulseSynchronizer, MultiReg
 
+from microscope.trigger import TriggerUnit
+
 
-__all__ = ["InsertRegistry", "ProbeAsync", "ProbeSingle", "ProbeBuffer"]
+__all__ = ["InsertRegistry", "ProbeAsync", "ProbeSingle", "ProbeCounter", "ProbeBuffer",
+           "ProbeHistogram", "get_timestamp_words"]
 
 
 class InsertRegistry:
@@ -74,20 +80,461 @@ class ProbeSingle(Insert):
         ]
 
 
+class ProbeCounter(Insert):
+    """Counts the cycles of ``clock_domain`` during which ``condition`` holds,
+    together with the total number of cycles. Arming takes a snapshot of both
+    counts and clears them, so that each readback covers the time since the
+    previous arm. The data is the event count in the low ``width`` bits and
+    the cycle count above. Both stop when the cycle count saturates.
+    ``clk_freq`` is the frequency of ``clock_domain``, for the client to
+    compute rates; it defaults to the system clock frequency for the ``sys``
+    domain."""
+    def __init__(self, registry, group, name, condition, width=32, clock_domain="sys",
+                 clk_freq=None):
+        Insert.__init__(self, registry, group, name)
+        self.condition = condition
+        self.width = width
+        self.clock_domain = clock_domain
+        self.clk_freq = clk_freq
+
+    def create_insert_logic(self):
+        self.arm = Signal()
+        self.pending = Signal()
+        self.data = Signal(2*self.width)
+
+        buf = Signal(2*self.width)
+        buf.attr.add("no_retiming")
+        self.specials += MultiReg(buf, self.data, "microscope")
+
+        ps_arm = PulseSynchronizer("microscope", self.clock_domain)
+        ps_done = PulseSynchronizer(self.clock_domain, "microscope")
+        self.submodules += ps_arm, ps_done
+        self.comb += ps_arm.i.eq(self.arm)
+        self.sync.microscope += [
+            If(ps_done.o, self.pending.eq(0)),
+            If(self.arm, self.pending.eq(1))
+        ]
+
+        events = Signal(self.width)
+        cycles = Signal(self.width)
+        sync = getattr(self.sync, self.clock_domain)
+        sync += [
+            ps_done.i.eq(0),
+            If(cycles != 2**self.width-1,
+                cycles.eq(cycles + 1),
+                If(self.condition,
+                    events.eq(events + 1)
+                )
+            ),
+            If(ps_arm.o,
+                buf.eq(Cat(events, cycles)),
+                events.eq(0),
+                cycles.eq(0),
+                ps_done.i.eq(1)
+            )
+        ]
+
+
 class ProbeBuffer(Insert):
-    def __init__(self, registry, group, name, target, trigger=1, depth=256, clock_domain="sys"):
+    def __init__(self, registry, group, name, target, trigger=1, depth=256, clock_domain="sys",
+                 segments=1, timestamp_width=32,
+                 qualifier=None, store_on_change=False, delta_width=16,
+                 programmable_trigger=False, sequence_width=16,
+                 pretrigger=0, decimation_width=0, double_buffered=False):
         Insert.__init__(self, registry, group, name)
         self.target = target
         self.trigger = trigger
+        self.programmable_trigger = programmable_trigger
+        self.sequence_width = sequence_width
         self.depth = depth
         self.clock_domain = clock_domain
+        if depth % segments:
+            raise ValueError("Depth must be a multiple of the number of segments")
+        self.segments = segments
+        self.timestamp_width = timestamp_width
+        self.qualifier = qualifier
+        self.store_on_change = store_on_change
+        if qualifier is None and not store_on_change:
+            delta_width = 0
+        self.delta_width = delta_width
+        if not 0 <= pretrigger < depth:
+            raise ValueError("Pre-trigger length must be less than the depth")
+        if pretrigger and (segments > 1 or delta_width or decimation_width):
+            raise ValueError("Pre-trigger capture is not supported with segments, "
+                             "storage qualification or decimation")
+        self.pretrigger = pretrigger
+        if decimation_width and delta_width:
+            raise ValueError("Decimation is not supported with storage qualification")
+        self.decimation_width = decimation_width
+        if double_buffered and segments > 1:
+            raise ValueError("Double buffering is not supported with segments")
+        self.double_buffered = double_buffered
+
+    def create_insert_logic(self):
+        # With storage qualification, each sample is stored together with
+        # the number of cycles since the previous stored sample.
+        width = len(self.target) + self.delta_width
+
+        # In segmented mode, the trigger timestamps of the segments follow
+        # the samples in the readback address space. Each timestamp is split
+        # into a power of two number of words of the sample width.
+        self.readback_depth = self.depth
+        if self.segments > 1:
+            timestamp_words = get_timestamp_words(width, self.timestamp_width)
+            self.readback_depth += self.segments*timestamp_words
+
+        self.arm = Signal()
+        self.pending = Signal()
+        self.address = Signal(max=self.readback_depth)
+        self.data = Signal(width)
+        # With double buffering, the memory has two halves. One is read back
+        # while the other captures.
+        halves = 2 if self.double_buffered else 1
+        self.specials.memory = Memory(width, halves*self.depth)
+
+        rdport = self.memory.get_port(clock_domain="microscope")
+        self.specials += rdport
+        self.comb += self.data.eq(rdport.dat_r)
+        write_address = Signal(max=max(self.depth, 2))
+        if self.pretrigger:
+            # The memory is written circularly, and the readback starts from
+            # the oldest sample, which is where the next one would have gone
+            # at the end of the capture.
+            oldest_address = Signal(max=self.depth)
+            oldest_address.attr.add("no_retiming")
+            oldest_address_sync = Signal(max=self.depth)
+            self.specials += MultiReg(oldest_address, oldest_address_sync, "microscope")
+            rotated_address = Signal(max=2*self.depth)
+            sample_address = Signal(max=self.depth)
+            self.comb += [
+                rotated_address.eq(self.address + oldest_address_sync),
+                If(rotated_address >= self.depth,
+                    sample_address.eq(rotated_address - self.depth)
+                ).Else(
+                    sample_address.eq(rotated_address)
+                )
+            ]
+        else:
+            sample_address = self.address
+        if self.double_buffered:
+            read_half = Signal()
+            read_half.attr.add("no_retiming")
+            read_half_sync = Signal()
+            self.specials += MultiReg(read_half, read_half_sync, "microscope")
+            self.comb += rdport.adr.eq(sample_address + Mux(read_half_sync, self.depth, 0))
+        else:
+            self.comb += rdport.adr.eq(sample_address)
+
+        ps_arm = PulseSynchronizer("microscope", self.clock_domain)
+        ps_done = PulseSynchronizer(self.clock_domain, "microscope")
+        self.submodules += ps_arm, ps_done
+        self.comb += ps_arm.i.eq(self.arm)
+        self.sync.microscope += [
+            If(ps_done.o, self.pending.eq(0)),
+            If(self.arm, self.pending.eq(1))
+        ]
+
+        # With decimation, a sample is stored on the trigger and then every
+        # decimation+1 cycles. The factor is loaded from the microscope
+        # domain through decimation and decimation_load.
+        tick = Signal()
+        if self.decimation_width:
+            self.decimation = Signal(self.decimation_width)
+            self.decimation_load = Signal()
+            decimation = Signal(self.decimation_width)
+            decimation.attr.add("no_retiming")
+            divider_reload = Signal(self.decimation_width)
+            self.sync.microscope += If(self.decimation_load, decimation.eq(self.decimation))
+            self.specials += MultiReg(decimation, divider_reload, self.clock_domain)
+
+        # Cross-triggering: trigger_out pulses when this buffer triggers and
+        # a pulse on trigger_in triggers it. Both are in the microscope
+        # domain, so buffers in other clock domains trigger a few cycles late.
+        self.trigger_in = Signal()
+        self.trigger_out = Signal()
+        ps_trigger_in = PulseSynchronizer("microscope", self.clock_domain)
+        ps_trigger_out = PulseSynchronizer(self.clock_domain, "microscope")
+        self.submodules += ps_trigger_in, ps_trigger_out
+        self.comb += [
+            ps_trigger_in.i.eq(self.trigger_in),
+            self.trigger_out.eq(ps_trigger_out.o)
+        ]
+
+        port = self.memory.get_port(write_capable=True,
+                                    clock_domain=self.clock_domain)
+        self.specials += port
+
+        running = Signal()
+        wait_trigger = Signal()
+        triggered = Signal()
+        store = Signal()
+        segment_depth = self.depth//self.segments
+        segment_address = Signal(max=max(segment_depth, 2))
+        segment = Signal(max=max(self.segments, 2))
+        sync = getattr(self.sync, self.clock_domain)
+
+        if self.programmable_trigger:
+            self.submodules.trigger_unit = TriggerUnit(self.target, self.clock_domain,
+                                                       self.sequence_width)
+
+        # Loading the trigger or decimation registers restarts the capture in
+        # progress, and discards a completed capture that the host has not
+        # received yet, since they were made with the previous registers.
+        # The pulse reaches the capture logic after the registers.
+        restart = Signal()
+        loads = []
+        if self.programmable_trigger:
+            loads.append(self.trigger_unit.load_commit)
+        if self.decimation_width:
+            loads.append(self.decimation_load)
+        if loads:
+            ps_restart = PulseSynchronizer("microscope", self.clock_domain)
+            self.submodules += ps_restart
+            self.comb += ps_restart.i.eq(reduce(or_, loads))
+            sync += restart.eq(ps_restart.o)
+
+        # start begins a capture, and done pulses once its last sample is
+        # stored. With double buffering, a capture is restarted in the other
+        # half as soon as the previous one has completed and the host armed
+        # the insert. The capture started by an arm is thus completed by the
+        # next arm, which only waits if it has not completed yet.
+        start = Signal()
+        done = Signal()
+        capturing = Signal()
+        if self.double_buffered:
+            request = Signal()
+            captured = Signal()
+            swap = Signal()
+            self.comb += [
+                swap.eq((request | ps_arm.o) & captured & ~restart),
+                start.eq(swap | ((request | ps_arm.o) & ~capturing & ~captured) |
+                         (restart & (capturing | captured)))
+            ]
+            sync += [
+                ps_done.i.eq(swap),
+                If(ps_arm.o, request.eq(1)),
+                If(done,
+                    capturing.eq(0),
+                    captured.eq(1)
+                ),
+                If(restart, captured.eq(0)),
+                If(start, capturing.eq(1)),
+                If(swap,
+                    read_half.eq(~read_half),
+                    request.eq(0),
+                    captured.eq(0)
+                )
+            ]
+        else:
+            self.comb += [
+                start.eq(ps_arm.o | (restart & capturing)),
+                ps_done.i.eq(done)
+            ]
+            sync += [
+                If(done, capturing.eq(0)),
+                If(start, capturing.eq(1))
+            ]
+        if self.pretrigger:
+            if self.double_buffered:
+                captured_oldest_address = Signal(max=self.depth)
+                sync += [
+                    If(done, captured_oldest_address.eq(write_address)),
+                    If(swap, oldest_address.eq(captured_oldest_address))
+                ]
+            else:
+                sync += If(done, oldest_address.eq(write_address))
+
+        # The programmable trigger qualifies the fixed one, which defaults to
+        # always true.
+        trigger = self.trigger
+        if self.programmable_trigger:
+            self.comb += self.trigger_unit.clear.eq(start | triggered)
+            trigger = trigger & self.trigger_unit.trigger
+        self.comb += [
+            triggered.eq(wait_trigger & (trigger | ps_trigger_in.o)),
+            ps_trigger_out.i.eq(triggered)
+        ]
+        if self.decimation_width:
+            divider = Signal(self.decimation_width)
+            self.comb += tick.eq(triggered | (divider == 0))
+            sync += If(store,
+                divider.eq(divider_reload)
+            ).Elif(divider != 0,
+                divider.eq(divider - 1)
+            )
+            sync += If(start, divider.eq(0))
+        else:
+            self.comb += tick.eq(1)
+
+        # In pre-trigger mode, samples are stored from the arm on, and the
+        # trigger is only accepted once pretrigger samples have been stored.
+        # The segment address then starts at pretrigger, so that the capture
+        # ends depth-pretrigger samples after the trigger.
+        if self.pretrigger:
+            pretriggering = Signal()
+            pretrigger_count = Signal(max=self.pretrigger+1)
+            sync += [
+                If(store & pretriggering & ~triggered,
+                    If(write_address == self.depth-1,
+                        write_address.eq(0)
+                    ).Else(
+                        write_address.eq(write_address + 1)
+                    ),
+                    If(pretrigger_count == self.pretrigger-1,
+                        wait_trigger.eq(1)
+                    ),
+                    If(pretrigger_count != self.pretrigger,
+                        pretrigger_count.eq(pretrigger_count + 1)
+                    )
+                ),
+                If(triggered,
+                    pretriggering.eq(0)
+                ),
+                If(start,
+                    pretriggering.eq(1),
+                    pretrigger_count.eq(0)
+                )
+            ]
+            capture = running | pretriggering
+            next_write_address = Mux(write_address == self.depth-1, 0, write_address + 1)
+            post_trigger = ~pretriggering | triggered
+        else:
+            capture = running
+            next_write_address = write_address + 1
+            post_trigger = 1
+        sync += [
+            done.eq(0),
+            If(triggered,
+                running.eq(1),
+                wait_trigger.eq(0)
+            ),
+            If(store & post_trigger,
+                write_address.eq(next_write_address),
+                segment_address.eq(segment_address + 1),
+                If(segment_address == segment_depth-1,
+                    running.eq(0),
+                    segment_address.eq(0),
+                    If(segment == self.segments-1,
+                        done.eq(1)
+                    ).Else(
+                        segment.eq(segment + 1),
+                        wait_trigger.eq(1)
+                    )
+                )
+            ),
+            If(start,
+                wait_trigger.eq(self.pretrigger == 0),
+                write_address.eq(0),
+                segment_address.eq(self.pretrigger),
+                segment.eq(0)
+            )
+        ]
+        if self.double_buffered:
+            sync += port.adr.eq(write_address + Mux(read_half, 0, self.depth))
+        else:
+            sync += port.adr.eq(write_address)
+        sync += port.we.eq(store)
+
+        if self.delta_width:
+            qualifier = 1 if self.qualifier is None else self.qualifier
+            delta = Signal(self.delta_width)
+            current_delta = Signal(self.delta_width)
+            self.comb += current_delta.eq(Mux(triggered, 0, delta))
+            if self.store_on_change:
+                last_target = Signal.like(self.target)
+                sync += If(store, last_target.eq(self.target))
+                qualifier = qualifier & (triggered | (self.target != last_target))
+            # A sample is also stored when the delta would overflow, so that
+            # the capture can be placed exactly on the cycle timeline.
+            self.comb += store.eq((triggered | running) &
+                                  (qualifier | (current_delta == 2**self.delta_width-1)))
+            sync += [
+                If(store,
+                    delta.eq(1)
+                ).Else(
+                    delta.eq(current_delta + 1)
+                ),
+                port.dat_w.eq(Cat(self.target, current_delta))
+            ]
+        else:
+            self.comb += store.eq((triggered | capture) & tick)
+            sync += port.dat_w.eq(self.target)
+
+        if self.segments > 1:
+            self.specials.timestamps = Memory(self.timestamp_width, self.segments)
+            timestamp = Signal(self.timestamp_width)
+            sync += [
+                timestamp.eq(timestamp + 1),
+                If(start, timestamp.eq(0))
+            ]
+            timestamp_port = self.timestamps.get_port(write_capable=True,
+                                                      clock_domain=self.clock_domain)
+            self.specials += timestamp_port
+            self.comb += [
+                timestamp_port.adr.eq(segment),
+                timestamp_port.dat_w.eq(timestamp),
+                timestamp_port.we.eq(triggered)
+            ]
+
+            timestamp_rdport = self.timestamps.get_port(clock_domain="microscope")
+            self.specials += timestamp_rdport
+            timestamp_word_bits = log2_int(timestamp_words)
+            timestamp_address = Signal(len(self.address))
+            current_timestamp_address = Signal(len(self.address))
+            self.sync.microscope += current_timestamp_address.eq(timestamp_address)
+            timestamp_data = Signal(timestamp_words*len(self.data))
+            self.comb += timestamp_data.eq(timestamp_rdport.dat_r)
+            if timestamp_word_bits:
+                timestamp_word = Array(timestamp_data[i*len(self.data):(i+1)*len(self.data)]
+                                       for i in range(timestamp_words))
+                timestamp_word = timestamp_word[current_timestamp_address[:timestamp_word_bits]]
+            else:
+                timestamp_word = timestamp_data
+            self.comb += [
+                timestamp_address.eq(self.address - self.depth),
+                timestamp_rdport.adr.eq(timestamp_address[timestamp_word_bits:]),
+                If(current_timestamp_address < self.segments*timestamp_words,
+                    self.data.eq(timestamp_word)
+                )
+            ]
+
+
+class ProbeHistogram(Insert):
+    """Accumulates a histogram of the values of ``target`` in ``bins`` bins
+    of ``bin_width`` values each (a power of two). Values past the last bin
+    are counted in the last bin. With ``qualifier``, only the cycles during
+    which it holds are counted. Each bin is a saturating counter of
+    ``counter_width`` bits, and the bins are read back like the samples of
+    a buffer.
+
+    Arming clears the bins, which takes ``bins`` cycles, and starts a new
+    accumulation. With ``duration``, the accumulation stops after that many
+    cycles, and the insert is pending until then. Otherwise, it runs until
+    the next arm, and the insert is pending only while the bins are cleared.
+
+    The counters are incremented in one cycle, so the memory has a read port
+    in ``clock_domain`` besides the readback port. FPGA tools usually
+    implement it with two copies of the memory."""
+    def __init__(self, registry, group, name, target, bins=256, bin_width=1, counter_width=32,
+                 qualifier=None, duration=None, clock_domain="sys"):
+        Insert.__init__(self, registry, group, name)
+        self.target = target
+        if bins < 2:
+            raise ValueError("A histogram needs at least two bins")
+        self.depth = bins
+        self.bin_width = bin_width
+        self.bin_shift = log2_int(bin_width)
+        self.counter_width = counter_width
+        self.qualifier = qualifier
+        self.duration = duration
+        self.clock_domain = clock_domain
 
     def create_insert_logic(self):
         self.arm = Signal()
         self.pending = Signal()
         self.address = Signal(max=self.depth)
-        self.data = Signal(len(self.target))
-        self.specials.memory = Memory(len(self.target), self.depth)
+        self.data = Signal(self.counter_width)
+        self.specials.memory = Memory(self.counter_width, self.depth)
 
         rdport = self.memory.get_port(clock_domain="microscope")
         self.specials += rdport
@@ -105,29 +552,94 @@ class ProbeBuffer(Insert):
             If(self.arm, self.pending.eq(1))
         ]
 
-        port = self.memory.get_port(write_capable=True,
-                                    clock_domain=self.clock_domain)
-        self.specials += port
+        count_port = self.memory.get_port(clock_domain=self.clock_domain)
+        port = self.memory.get_port(write_capable=True, clock_domain=self.clock_domain)
+        self.specials += count_port, port
 
+        clearing = Signal()
         running = Signal()
-        wait_trigger = Signal()
+        clear_address = Signal(max=self.depth)
         sync = getattr(self.sync, self.clock_domain)
         sync += [
             ps_done.i.eq(0),
-            If(running,
-                port.adr.eq(port.adr + 1),
-                If(port.adr == self.depth-1,
+            If(clearing,
+                clear_address.eq(clear_address + 1),
+                If(clear_address == self.depth-1,
+                    clearing.eq(0),
+                    running.eq(1),
+                    ps_done.i.eq(self.duration is None)
+                )
+            )
+        ]
+        start = [
+            clearing.eq(1),
+            running.eq(0),
+            clear_address.eq(0)
+        ]
+        if self.duration is not None:
+            remaining = Signal(max=self.duration+1)
+            sync += If(running,
+                remaining.eq(remaining - 1),
+                If(remaining == 1,
                     running.eq(0),
                     ps_done.i.eq(1)
                 )
+            )
+            start.append(remaining.eq(self.duration))
+        sync += If(ps_arm.o, *start)
+
+        # The counter of a bin is read in the cycle after the sample, and
+        # written back incremented in the next one. When consecutive samples
+        # fall into the same bin, the count just written is used instead of
+        # the stale one read from the memory.
+        shifted = Signal.like(self.target)
+        current_bin = Signal(max=self.depth)
+        self.comb += [
+            shifted.eq(self.target >> self.bin_shift),
+            If(shifted > self.depth-1,
+                current_bin.eq(self.depth-1)
+            ).Else(
+                current_bin.eq(shifted)
             ),
-            If(wait_trigger & self.trigger,
-                running.eq(1),
-                wait_trigger.eq(0)
+            count_port.adr.eq(current_bin)
+        ]
+
+        qualifier = 1 if self.qualifier is None else self.qualifier
+        sample = Signal()
+        sample_bin = Signal(max=self.depth)
+        last_write = Signal()
+        last_bin = Signal(max=self.depth)
+        last_count = Signal(self.counter_width)
+        count = Signal(self.counter_width)
+        sync += [
+            sample.eq(running & qualifier),
+            sample_bin.eq(current_bin),
+            last_write.eq(port.we),
+            last_bin.eq(port.adr),
+            last_count.eq(port.dat_w)
+        ]
+        self.comb += [
+            If(last_write & (last_bin == sample_bin),
+                count.eq(last_count)
+            ).Else(
+                count.eq(count_port.dat_r)
             ),
-            If(ps_arm.o,
-                wait_trigger.eq(1)
+            If(clearing,
+                port.adr.eq(clear_address),
+                port.dat_w.eq(0),
+                port.we.eq(1)
+            ).Else(
+                port.adr.eq(sample_bin),
+                If(count == 2**self.counter_width-1,
+                    port.dat_w.eq(count)
+                ).Else(
+                    port.dat_w.eq(count + 1)
+                ),
+                port.we.eq(sample)
             )
         ]
-        self.comb += port.we.eq(running)
-        sync += port.dat_w.eq(self.target)
+
+
+def get_timestamp_words(width, timestamp_width):
+    words = (timestamp_width + width - 1)//width
+    return 1 << (words - 1).bit_length()
@@ -1,26 +1,190 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import argparse
 import struct
+import time
+import math
+import json
+import zipfile
+import threading
+import concurrent.futures
 
 import serial
 import msgpack
 import prettytable
 
+from microscope.inserts import get_timestamp_words
+from microscope.vcd import iter_samples, write_vcd
+
+
+# Makes spi:// URLs available (see protocol_spi).
+serial.protocol_handler_packages.append("microscope")
+
+
+def decompress(read, width, count):
+    """Decodes ``count`` samples of ``width`` bits from a compressed readback,
+    where ``read(n)`` returns the next ``n`` bytes of the stream. The result
+    has the same layout as an uncompressed readback."""
+    word_len = (width+7)//8
+    mask = 2**width - 1
+    previous = delta = 0
+    samples = []
+    while len(samples) < count:
+        header = read(1)[0]
+        if header & 0x80:
+            for _ in range((header & 0x7f) + 1):
+                previous = (previous + delta) & mask
+                samples.append(previous)
+        else:
+            value = int.from_bytes(read(word_len), "little")
+            delta = (value - previous) & mask
+            previous = value
+            samples.append(value)
+    return b"".join(sample.to_bytes(word_len, "little") for sample in samples)
+
+
+def crc16(data, crc=0xffff):
+    """CRC-16/CCITT (polynomial 0x1021), as used by checked readback."""
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+
+def get_default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+                                os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "microscope")
+
 
 class Comm:
     magic = b"\x1a\xe5\x52\x9c"
 
-    def __init__(self, port_url):
-        self.ser = serial.serial_for_url(port_url, baudrate=115200)
+    def __init__(self, port_url, baudrate=115200, cache_dir=None):
+        self.ser = serial.serial_for_url(port_url, baudrate=baudrate)
+        self.default_baudrate = baudrate
+        self.cache_dir = cache_dir
+        self.config = None
 
     def close(self):
+        if self.ser.baudrate != self.default_baudrate:
+            self.set_baudrate(0)
+            self.ser.flush()
         self.ser.close()
 
-    def get_config(self):
+    def get_config_hash(self):
+        self.ser.write(Comm.magic + b"\x09")
+        # Devices without the hash command do not reply.
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.5
+        try:
+            config_hash = self.ser.read(16)
+        finally:
+            self.ser.timeout = timeout
+        if len(config_hash) != 16:
+            return None
+        return config_hash
+
+    def get_raw_config(self):
         self.ser.write(Comm.magic + b"\x00")
-        return next(msgpack.Unpacker(self.ser, read_size=1))
+        # The device sends nothing after the config, so everything that has
+        # been received so far can be consumed at once.
+        unpacker = msgpack.Unpacker()
+        raw_config = b""
+        while True:
+            data = self.ser.read(max(self.ser.in_waiting, 1))
+            if not data:
+                raise TimeoutError("Timeout reading the configuration")
+            raw_config += data
+            unpacker.feed(data)
+            try:
+                unpacker.unpack()
+            except msgpack.OutOfData:
+                pass
+            else:
+                return raw_config
+
+    def get_config(self):
+        if self.config is None:
+            cache_file = None
+            if self.cache_dir is not None:
+                config_hash = self.get_config_hash()
+                if config_hash is not None:
+                    cache_file = os.path.join(self.cache_dir, config_hash.hex() + ".msgpack")
+            raw_config = None
+            if cache_file is not None:
+                try:
+                    with open(cache_file, "rb") as f:
+                        raw_config = f.read()
+                except OSError:
+                    pass
+            if raw_config is None:
+                raw_config = self.get_raw_config()
+                if cache_file is not None:
+                    try:
+                        os.makedirs(self.cache_dir, exist_ok=True)
+                        with open(cache_file + ".tmp", "wb") as f:
+                            f.write(raw_config)
+                        os.replace(cache_file + ".tmp", cache_file)
+                    except OSError:
+                        pass
+            self.config = msgpack.unpackb(raw_config)
+        return self.config
+
+    def set_baudrate(self, index):
+        self.ser.write(Comm.magic + b"\x05" + struct.pack("B", index))
+
+    def confirm_baudrate(self):
+        self.ser.write(Comm.magic + b"\x12")
+
+    def _try_baudrate(self, index, baudrate, settle_time):
+        previous = self.ser.baudrate
+        try:
+            self.ser.baudrate = baudrate
+        except (ValueError, serial.SerialException):
+            return False
+        self.ser.baudrate = previous
+        self.set_baudrate(index)
+        self.ser.flush()
+        self.ser.baudrate = baudrate
+        time.sleep(settle_time)
+        self.ser.reset_input_buffer()
+        # The rate is only confirmed on the device once a reply has come back,
+        # so that it also falls back when only the host to device direction
+        # works.
+        self.ser.write(Comm.magic + b"\x03")
+        if self.ser.read(1) in (b"\x00", b"\x01"):
+            self.confirm_baudrate()
+            self.ser.flush()
+            return True
+        # Wait for the device to time out and fall back to its default rate.
+        time.sleep(0.2)
+        self.ser.baudrate = self.default_baudrate
+        self.ser.reset_input_buffer()
+        return False
+
+    def negotiate_baudrate(self, max_baudrate=None, settle_time=0.01):
+        baudrates = self.get_config().get("bdr", [])
+        candidates = sorted(enumerate(baudrates), key=lambda c: c[1], reverse=True)
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.1
+        try:
+            for index, baudrate in candidates:
+                if baudrate <= self.ser.baudrate:
+                    break
+                if max_baudrate is not None and baudrate > max_baudrate:
+                    continue
+                if self._try_baudrate(index, baudrate, settle_time):
+                    break
+        finally:
+            self.ser.timeout = timeout
+        return self.ser.baudrate
 
     def select(self, insert):
         self.ser.write(Comm.magic + b"\x01" + struct.pack("B", insert))
@@ -32,33 +196,328 @@ class Comm:
         self.ser.write(Comm.magic + b"\x03")
         return struct.unpack("?", self.ser.read(1))[0]
 
+    def arm_wait(self, timeout=None, armed=None):
+        """Arms the selected insert and blocks until it has captured.
+        Returns False if ``timeout`` (in seconds) expired first. ``armed``
+        is called once the command has been sent."""
+        self.ser.write(Comm.magic + b"\x08")
+        return self._wait_done(timeout, armed)
+
+    def _group_payload(self, inserts, cross_trigger):
+        mask = 0
+        for insert in inserts:
+            mask |= 1 << insert
+        mask_len = (len(self.get_config()["ins"])+7)//8
+        return struct.pack("B", int(cross_trigger)) + mask.to_bytes(mask_len, "little")
+
+    def arm_group(self, inserts, cross_trigger=False):
+        """Arms all ``inserts`` (a list of insert indices) in the same cycle.
+        With ``cross_trigger``, the first buffer to trigger also triggers
+        the others."""
+        self.ser.write(Comm.magic + b"\x0b" + self._group_payload(inserts, cross_trigger))
+
+    def arm_group_wait(self, inserts, cross_trigger=False, timeout=None, armed=None):
+        """Like ``arm_group``, and blocks until all inserts have captured.
+        Returns False if ``timeout`` (in seconds) expired first. ``armed``
+        is called once the command has been sent."""
+        self.ser.write(Comm.magic + b"\x0c" + self._group_payload(inserts, cross_trigger))
+        return self._wait_done(timeout, armed)
+
+    def _wait_done(self, timeout, armed=None):
+        if armed is not None:
+            self.ser.flush()
+            armed()
+        previous_timeout = self.ser.timeout
+        self.ser.timeout = timeout
+        try:
+            done = self.ser.read(1) == b"\x01"
+        finally:
+            self.ser.timeout = previous_timeout
+        if not done:
+            self.ser.write(b"\x00")
+            self.ser.flush()
+            time.sleep(0.05)
+            self.ser.reset_input_buffer()
+        return done
+
+    def set_window(self, start, count, stride=1):
+        self.ser.write(Comm.magic + b"\x0a" + struct.pack("<III", start, count, stride))
+
+    def set_trigger(self, registers):
+        """Loads the registers of the programmable trigger of the selected
+        insert (see ``encode_trigger``)."""
+        self.ser.write(Comm.magic + b"\x10" + struct.pack("B", len(registers)) + registers)
+
+    def set_decimation(self, factor):
+        """Makes the selected buffer store one sample every ``factor``
+        cycles."""
+        self.ser.write(Comm.magic + b"\x11" + struct.pack("<I", factor - 1))
+
     def data(self, length):
         self.ser.write(Comm.magic + b"\x04")
         return self.ser.read(length)
 
+    def data_checked(self, word_len, count, chunk):
+        """Reads back ``count`` samples of ``word_len`` bytes of the selected
+        insert, each chunk of ``chunk`` samples followed by its CRC. Returns
+        the list of chunks, with ``None`` for those that failed the check."""
+        self.ser.write(Comm.magic + b"\x0f" + struct.pack("<H", chunk))
+        chunks = []
+        previous_timeout = self.ser.timeout
+        # A dropped byte leaves the last chunk incomplete, so reads must time
+        # out.
+        self.ser.timeout = 0.5 + 20*(chunk*word_len + 2)/self.ser.baudrate
+        try:
+            for n in range(0, count, chunk):
+                length = min(chunk, count - n)*word_len
+                data = self.ser.read(length + 2)
+                if (len(data) == length + 2
+                        and crc16(data[:length]) == struct.unpack("<H", data[length:])[0]):
+                    chunks.append(data[:length])
+                else:
+                    chunks.append(None)
+        finally:
+            self.ser.timeout = previous_timeout
+        if None in chunks:
+            time.sleep(0.05)
+            self.ser.reset_input_buffer()
+        return chunks
+
+    def data_verified(self, word_len, start, count, stride=1, chunk=None, retries=3):
+        """Reads back the selected insert (or its window, which covers
+        ``count`` samples from ``start`` with ``stride``) with checked
+        readback. Chunks that fail the check are read again from the probe
+        memory, through a window that covers only them, which is left set
+        afterwards. Raises ``IOError`` if a chunk fails ``retries`` more
+        times."""
+        if chunk is None:
+            chunk = max(256//word_len, 1)
+        chunks = self.data_checked(word_len, count, chunk)
+        for n, data in enumerate(chunks):
+            attempts = 0
+            while data is None:
+                if attempts == retries:
+                    raise IOError("Chunk {} of the readback is corrupted".format(n))
+                attempts += 1
+                chunk_count = min(chunk, count - n*chunk)
+                self.set_window(start + n*chunk*stride, chunk_count, stride)
+                data = self.data_checked(word_len, chunk_count, chunk)[0]
+            chunks[n] = data
+        return b"".join(chunks)
+
+    def data_compressed(self, width, count):
+        self.ser.write(Comm.magic + b"\x06")
+        return decompress(self.ser.read, width, count)
+
+    def data_group(self, length):
+        """Reads back the inserts of the last group arm, in insert order."""
+        self.ser.write(Comm.magic + b"\x0d")
+        return self.ser.read(length)
+
+    def data_group_checked(self, lengths):
+        """Reads back the inserts of the last group arm, in insert order,
+        each followed by its CRC. ``lengths`` are the lengths of their data.
+        Returns the data of each insert, with ``None`` for those that failed
+        the check."""
+        self.ser.write(Comm.magic + b"\x13")
+        inserts = []
+        previous_timeout = self.ser.timeout
+        # A dropped byte leaves the last insert incomplete, so reads must
+        # time out.
+        self.ser.timeout = 0.5 + 20*(max(lengths) + 2)/self.ser.baudrate
+        try:
+            for length in lengths:
+                data = self.ser.read(length + 2)
+                if (len(data) == length + 2
+                        and crc16(data[:length]) == struct.unpack("<H", data[length:])[0]):
+                    inserts.append(data[:length])
+                else:
+                    inserts.append(None)
+        finally:
+            self.ser.timeout = previous_timeout
+        if None in inserts:
+            time.sleep(0.05)
+            self.ser.reset_input_buffer()
+        return inserts
+
+    def snapshot(self, length, group=None):
+        if group is None:
+            group = 0xff
+        self.ser.write(Comm.magic + b"\x07" + struct.pack("B", group))
+        return self.ser.read(length)
+
+    def stream_start(self, inserts, interval):
+        """Makes the device capture the single-value ``inserts`` (a list of
+        insert indices) every ``interval`` clock cycles, and send their
+        values in frames of 0xa5, a 16-bit sequence number and the samples
+        in insert order. The sequence number counts intervals, including
+        those the device skipped because the link was busy."""
+        self.ser.write(Comm.magic + b"\x0e" + struct.pack("<I", interval) +
+                       self._group_payload(inserts, False))
+
+    def stream_stop(self):
+        # The device completes the current frame before stopping.
+        self.ser.write(b"\x00")
+        self.ser.flush()
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.05
+        try:
+            while self.ser.read(max(self.ser.in_waiting, 1)):
+                pass
+        finally:
+            self.ser.timeout = timeout
+
 
 def display_inserts(comm):
     config = comm.get_config()
     table = prettytable.PrettyTable(["Group", "Name", "Width", "Depth"])
-    for group, name, width, depth in config["ins"]:
+    for group, name, width, depth, *_ in config["ins"]:
         group = config["grp"][group]
         table.add_row([group, name, width, depth])
     print(table)
 
 
-def display_singles(comm):
+def display_singles(comm, q_group=None):
     config = comm.get_config()
+    if q_group is None:
+        group_filter = None
+    else:
+        try:
+            group_filter = config["grp"].index(q_group)
+        except ValueError:
+            raise SystemExit("Group not found")
+    # Snapshots leave out the counters, as arming them clears them.
+    singles = []
+    for element in config["ins"]:
+        group, name, width, depth, *_ = element
+        if (depth == 1 and "cnt" not in get_insert_options(element)
+                and (group_filter is None or group == group_filter)):
+            singles.append((group, name, width))
+    data = comm.snapshot(sum((width+7)//8 for _, _, width in singles), group_filter)
     table = prettytable.PrettyTable(["Group", "Name", "Value"])
-    for i, (group, name, width, depth) in enumerate(config["ins"]):
-        if depth == 1:
-            comm.select(i)
-            comm.arm()
-            while comm.pending():
-                pass
-            data = comm.data((width+7)//8)
-            value = int.from_bytes(data, "little")
-            group = config["grp"][group]
-            table.add_row([group, name, hex(value)])
+    offset = 0
+    for group, name, width in singles:
+        word_len = (width+7)//8
+        value = int.from_bytes(data[offset:offset+word_len], "little")
+        offset += word_len
+        table.add_row([config["grp"][group], name, hex(value)])
+    print(table)
+
+
+def display_counters(comm, q_group=None, interval=1.0, watch=False):
+    config = comm.get_config()
+    if q_group is None:
+        group_filter = None
+    else:
+        try:
+            group_filter = config["grp"].index(q_group)
+        except ValueError:
+            raise SystemExit("Group not found")
+    # The counters are armed as a group, which takes a snapshot of all of
+    # them in the same cycle and clears them.
+    counters = [i for i, element in enumerate(config["ins"])
+                if "cnt" in get_insert_options(element)
+                and (group_filter is None or element[0] == group_filter)]
+    if not counters:
+        raise SystemExit("No counters found")
+
+    comm.arm_group_wait(counters)
+    cleared = time.monotonic()
+    while True:
+        time.sleep(interval)
+        comm.arm_group_wait(counters)
+        now = time.monotonic()
+        elapsed = now - cleared
+        cleared = now
+
+        table = prettytable.PrettyTable(["Group", "Name", "Events", "Cycles", "Duty cycle",
+                                         "Rate (1/s)"])
+        for capture in read_captures(comm, config, counters):
+            options = capture.options
+            value = int.from_bytes(capture.data, "little")
+            counter_width = options["cnt"]
+            events = value & (2**counter_width - 1)
+            cycles = value >> counter_width
+            duty = "{:.3f}%".format(100*events/cycles) if cycles else "-"
+            # Without the counter clock frequency, rates are relative to the
+            # time between snapshots on the host.
+            if "clk" in options and cycles:
+                rate = events*options["clk"]/cycles
+            else:
+                rate = events/elapsed
+            if cycles == 2**counter_width - 1:
+                duty += " (saturated)"
+            table.add_row([capture.group, capture.name, events, cycles, duty,
+                           "{:.6g}".format(rate)])
+        print(table)
+        if not watch:
+            break
+
+
+def get_percentiles(counts, percentiles):
+    """Returns the index of the bin that contains each of ``percentiles``
+    (in percent) of the samples counted in ``counts``."""
+    total = sum(counts)
+    r = []
+    for percentile in percentiles:
+        rank = max(1, math.ceil(percentile/100*total))
+        cumulative = 0
+        for i, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank:
+                break
+        r.append(i)
+    return r
+
+
+def display_histogram(comm, q_group, q_name, q_n, interval=1.0, show_bins=False):
+    config = comm.get_config()
+    found = [i for i in find_inserts(config, q_group, [q_name], q_n)
+             if "bin" in get_insert_options(config["ins"][i])]
+    if not found:
+        raise SystemExit("Histogram not found")
+    if len(found) > 1:
+        raise SystemExit("More than one insert matches")
+    options = get_insert_options(config["ins"][found[0]])
+    counter_width = config["ins"][found[0]][2]
+    bin_width = options["bin"]
+
+    # Histograms without a set duration accumulate until the next arm, and
+    # are read back while they run.
+    comm.select(found[0])
+    comm.arm_wait()
+    if "dur" not in options:
+        time.sleep(interval)
+    capture, = read_captures(comm, config, found)
+    counts = [value for _, value in capture.iter_samples()]
+
+    def bin_range(i):
+        low = i*bin_width
+        if i == len(counts)-1:
+            return ">= {}".format(low)
+        elif bin_width == 1:
+            return str(low)
+        else:
+            return "{}-{}".format(low, low + bin_width - 1)
+
+    saturated = [i for i, count in enumerate(counts) if count == 2**counter_width - 1]
+    if show_bins:
+        table = prettytable.PrettyTable(["Bin", "Values", "Count"])
+        for i, count in enumerate(counts):
+            if count:
+                table.add_row([i, bin_range(i), count])
+        print(table)
+    total = sum(counts)
+    print("{} samples".format(total), file=sys.stderr)
+    if saturated:
+        print("{} saturated bin(s), percentiles are approximate".format(len(saturated)),
+              file=sys.stderr)
+    if not total:
+        return
+    percentiles = [50, 90, 99, 99.9, 99.99, 100]
+    table = prettytable.PrettyTable(["Percentile", "Values"])
+    for percentile, i in zip(percentiles, get_percentiles(counts, percentiles)):
+        table.add_row(["{:g}%".format(percentile), bin_range(i)])
     print(table)
 
 
@@ -66,12 +525,15 @@ def monitor_single(comm, q_group, q_name, q_n):
     config = comm.get_config()
     try:
         q_group = config["grp"].index(q_group)
-    except IndexError:
+    except ValueError:
         raise SystemExit("Group not found")
     found = None
     n = 0
-    for i, (group, name, width, depth) in enumerate(config["ins"]):
-        if group == q_group and name == q_name and depth == 1:
+    for i, element in enumerate(config["ins"]):
+        group, name, width, depth, *_ = element
+        # Arming a counter clears it, so counters are not monitored.
+        if (group == q_group and name == q_name and depth == 1
+                and "cnt" not in get_insert_options(element)):
             if q_n is None or n == q_n:
                 if found is not None:
                     raise SystemExit("More than one insert matches")
@@ -79,14 +541,12 @@ def monitor_single(comm, q_group, q_name, q_n):
     if found is None:
         raise SystemExit("Insert not found")
 
-    _, _, width, _ = config["ins"][found]
+    width = config["ins"][found][2]
     fmtstring = "{:0" + str((width+3)//4) + "x}"
     toggle = False
     comm.select(found)
     while True:
-        comm.arm()
-        while comm.pending():
-            pass
+        comm.arm_wait()
         data = comm.data((width+7)//8)
         value = int.from_bytes(data, "little")
         print(("/ " if toggle else "\\ ") + fmtstring.format(value),
@@ -94,64 +554,710 @@ def monitor_single(comm, q_group, q_name, q_n):
         toggle = not toggle
 
 
-def display_buffer(comm, q_group, q_name, q_n):
+def stream_singles(comm, q_group, q_names, q_n, interval, output=None, duration=None):
+    """Streams the values of single-value inserts captured every
+    ``interval`` seconds, until ``duration`` seconds have elapsed or the
+    user interrupts. Each frame is written to ``output`` as the 64-bit
+    sequence number followed by the samples. Returns statistics."""
     config = comm.get_config()
+    found = find_inserts(config, q_group, q_names, q_n)
+    if any(config["ins"][i][3] != 1 for i in found):
+        raise SystemExit("Only single-value inserts can be streamed")
+    if any("cnt" in get_insert_options(config["ins"][i]) for i in found):
+        raise SystemExit("Counters cannot be streamed, as each capture clears them")
+    if "clk" not in config:
+        raise SystemExit("Device does not report its clock frequency")
+    cycles = round(interval*config["clk"])
+    if cycles < 1 or cycles >= 2**32:
+        raise SystemExit("Interval out of range")
+    widths = [config["ins"][i][2] for i in found]
+    frame_len = 3 + sum((width+7)//8 for width in widths)
+    if output is not None:
+        print("record: 8-byte sequence number, then {}".format(", ".join(
+              "{} ({} bytes)".format(config["ins"][i][1], (config["ins"][i][2]+7)//8)
+              for i in found)), file=sys.stderr)
+
+    f = None if output is None else open(output, "wb")
+    buf = bytearray()
+    frames = dropped = resyncs = 0
+    sequence = None
+    timeout = comm.ser.timeout
+    comm.ser.timeout = 0.1
+    comm.stream_start(found, cycles)
+    started = last_status = time.monotonic()
+    try:
+        try:
+            while duration is None or time.monotonic() - started < duration:
+                buf += comm.ser.read(max(comm.ser.in_waiting, 1))
+                while len(buf) >= frame_len:
+                    if buf[0] != 0xa5:
+                        skip = buf.find(0xa5)
+                        del buf[:skip if skip > 0 else len(buf)]
+                        resyncs += 1
+                        continue
+                    raw_sequence = struct.unpack("<H", buf[1:3])[0]
+                    if sequence is None:
+                        sequence = raw_sequence
+                    else:
+                        delta = (raw_sequence - sequence) & 0xffff or 0x10000
+                        sequence += delta
+                        dropped += delta - 1
+                    frames += 1
+                    samples = bytes(buf[3:frame_len])
+                    del buf[:frame_len]
+                    if f is not None:
+                        f.write(struct.pack("<Q", sequence) + samples)
+                now = time.monotonic()
+                if frames and now - last_status > 0.5:
+                    last_status = now
+                    values = []
+                    offset = 0
+                    for width in widths:
+                        word_len = (width+7)//8
+                        values.append(("{:0" + str((width+3)//4) + "x}").format(
+                            int.from_bytes(samples[offset:offset+word_len], "little")))
+                        offset += word_len
+                    print("{} {} frames, {:.1f}/s, {} dropped".format(
+                          " ".join(values), frames, frames/(now - started), dropped),
+                          end="\r", file=sys.stderr, flush=True)
+        except KeyboardInterrupt:
+            pass
+        elapsed = time.monotonic() - started
+        comm.stream_stop()
+    finally:
+        comm.ser.timeout = timeout
+        if f is not None:
+            f.close()
+
+    print(file=sys.stderr)
+    statistics = {
+        "frames": frames,
+        "dropped": dropped,
+        "resyncs": resyncs,
+        "elapsed": elapsed,
+        "rate": frames/elapsed,
+        "requested_rate": config["clk"]/cycles
+    }
+    print("{frames} frames in {elapsed:.1f} s ({rate:.1f}/s of {requested_rate:.1f}/s requested), "
+          "{dropped} dropped, {resyncs} resynchronizations".format(**statistics), file=sys.stderr)
+    return statistics
+
+
+def get_window(depth, start=None, count=None, stride=None):
+    if start is None:
+        start = 0
+    if stride is None:
+        stride = 1
+    if start < 0 or start >= depth:
+        raise SystemExit("Start address out of range")
+    if stride < 1:
+        raise SystemExit("Stride must be positive")
+    available = (depth - 1 - start)//stride + 1
+    if count is None:
+        count = available
+    elif count < 1 or count > available:
+        raise SystemExit("Window exceeds the buffer")
+    return start, count, stride
+
+
+def get_insert_options(element):
+    if len(element) > 4:
+        return element[4]
+    else:
+        return {}
+
+
+def get_word_width(width, options):
+    return width + options.get("dtw", 0)
+
+
+def get_readback_depth(width, depth, options):
+    segments = options.get("seg", 1)
+    if segments > 1:
+        depth += segments*get_timestamp_words(get_word_width(width, options), options["tsw"])
+    return depth
+
+
+class Capture:
+    def __init__(self, group, name, width, depth, options, start, stride, data, decimation=1):
+        self.group = group
+        self.name = name
+        self.width = width
+        self.depth = depth
+        self.options = options
+        self.start = start
+        self.stride = stride
+        self.data = data
+        self.decimation = decimation
+
+        self.word_width = get_word_width(width, options)
+
+    def get_segments(self):
+        """Returns ``(timestamp, data)`` pairs for each segment of a complete
+        readback of a segmented buffer, and ``None`` otherwise."""
+        segments = self.options.get("seg", 1)
+        word_len = (self.word_width+7)//8
+        readback_depth = get_readback_depth(self.width, self.depth, self.options)
+        if (segments == 1 or self.start != 0 or self.stride != 1
+                or len(self.data) != readback_depth*word_len):
+            return None
+        timestamp_words = get_timestamp_words(self.word_width, self.options["tsw"])
+        segment_len = self.depth//segments*word_len
+        r = []
+        for i in range(segments):
+            timestamp = 0
+            for j in range(timestamp_words):
+                offset = (self.depth + i*timestamp_words + j)*word_len
+                word = int.from_bytes(self.data[offset:offset+word_len], "little")
+                timestamp |= word << (j*self.word_width)
+            r.append((timestamp, self.data[i*segment_len:(i+1)*segment_len]))
+        return r
+
+    def get_trigger_index(self):
+        """Returns the index in ``data`` of the trigger sample of a
+        pre-trigger capture, and ``None`` if it is not part of the readback."""
+        pretrigger = self.options.get("pre", 0)
+        if (not pretrigger or pretrigger < self.start
+                or (pretrigger - self.start) % self.stride):
+            return None
+        index = (pretrigger - self.start)//self.stride
+        if index >= len(self.data)//((self.word_width+7)//8):
+            return None
+        return index
+
+    def iter_samples(self):
+        """Yields ``(time, value)`` pairs, in sample clock cycles. Samples of
+        storage-qualified buffers are placed using their cycle deltas from
+        the trigger, and those of decimated buffers are ``decimation`` cycles
+        apart."""
+        segments = self.get_segments()
+        if segments is None and "dtw" in self.options:
+            segments = [(0, self.data)]
+        elif segments is None:
+            segments = [(self.start*self.decimation, self.data)]
+            stride = self.stride*self.decimation
+        else:
+            stride = self.decimation
+        for timestamp, data in segments:
+            if "dtw" in self.options:
+                time = timestamp
+                mask = 2**self.width - 1
+                for _, word in iter_samples(data, self.word_width):
+                    time += word >> self.width
+                    yield time, word & mask
+            else:
+                yield from iter_samples(data, self.width, timestamp, stride)
+
+
+trigger_modes = ["level", "rise", "fall", "change"]
+
+
+def parse_condition(text):
+    """Parses a trigger condition ``[MODE:]VALUE[/MASK]``, where ``MODE`` is
+    one of ``trigger_modes`` (default: level) and ``MASK`` defaults to all
+    bits, or ``change[/MASK]``. Returns ``(mode, value, mask)``, with a mask
+    of ``None`` for all bits."""
+    mode = "level"
+    if text == "change" or text.startswith("change/"):
+        mode, text = "change", "0" + text[6:]
+    elif ":" in text:
+        mode, text = text.split(":", 1)
+        if mode not in trigger_modes:
+            raise argparse.ArgumentTypeError("Unknown trigger mode: " + mode)
+    value, _, mask = text.partition("/")
+    try:
+        value = int(value, 0)
+        mask = int(mask, 0) if mask else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid trigger condition: " + text)
+    return trigger_modes.index(mode), value, mask
+
+
+def encode_trigger(width, sequence_width, a=None, b=None, within=0):
+    """Encodes the registers of a programmable trigger on a target of
+    ``width`` bits. ``a`` and ``b`` are conditions as returned by
+    ``parse_condition``. Without ``a``, the trigger is always true. With
+    ``b``, the trigger fires when ``b`` follows ``a`` by at most ``within``
+    cycles."""
+    if within >= 2**sequence_width:
+        raise ValueError("Trigger window too long")
+    if (b is None) != (within == 0):
+        raise ValueError("A second trigger condition requires a window, and conversely")
+    word_len = (width+7)//8
+    all_bits = 2**width - 1
+    registers = b""
+    modes = 0
+    for i, condition in enumerate([a, b]):
+        if condition is None:
+            mode, value, mask = 0, 0, 0
+        else:
+            mode, value, mask = condition
+            if mask is None:
+                mask = all_bits
+        registers += ((value & all_bits).to_bytes(word_len, "little") +
+                      (mask & all_bits).to_bytes(word_len, "little"))
+        modes |= mode << 2*i
+    return (registers + struct.pack("B", modes) +
+            within.to_bytes((sequence_width+7)//8, "little"))
+
+
+def load_capture_registers(comm, config, found, trigger=None, decimation=None):
+    """Loads the programmable triggers of ``found`` inserts with ``trigger``,
+    a tuple of ``encode_trigger`` arguments after the widths, and sets their
+    ``decimation`` factor. Both are reset when not given, to always true
+    and no decimation."""
+    for i in found:
+        group, name, width, depth, *_ = config["ins"][i]
+        options = get_insert_options(config["ins"][i])
+        if "trg" in options:
+            comm.select(i)
+            comm.set_trigger(encode_trigger(width, options["trg"], *(trigger or ())))
+        elif trigger is not None:
+            raise SystemExit("Insert {} has no programmable trigger".format(name))
+        if decimation is not None and decimation < 1:
+            raise SystemExit("Decimation factor must be positive")
+        if "dec" in options:
+            if decimation is not None and decimation > 2**options["dec"]:
+                raise SystemExit("Decimation factor of insert {} is at most {}".format(
+                                 name, 2**options["dec"]))
+            comm.select(i)
+            comm.set_decimation(decimation or 1)
+        elif decimation is not None and decimation != 1:
+            raise SystemExit("Insert {} has no decimation".format(name))
+
+
+def find_inserts(config, q_group, q_names, q_n):
     try:
         q_group = config["grp"].index(q_group)
-    except IndexError:
+    except ValueError:
         raise SystemExit("Group not found")
-    found = False
-    n = 0
-    for i, (group, name, width, depth) in enumerate(config["ins"]):
-        if group == q_group and name == q_name:
-            if q_n is None or n == q_n:
-                found = True
-                comm.select(i)
-                comm.arm()
-                print("waiting for trigger...", file=sys.stderr)
-                while comm.pending():
-                    pass
-                print("done", file=sys.stderr)
-
-                word_len = (width+7)//8
-                data = comm.data(depth*word_len)
-                print("[")
-                for j in range(depth):
-                    print(hex(int.from_bytes(data[j*word_len:(j+1)*word_len], "little")) + ",")
-                print("]")
-            n += 1
+    found = []
+    for q_name in q_names:
+        n = 0
+        for i, (group, name, width, depth, *_) in enumerate(config["ins"]):
+            if group == q_group and name == q_name:
+                if (q_n is None or n == q_n) and i not in found:
+                    found.append(i)
+                n += 1
     if not found:
         raise SystemExit("Insert not found")
+    found.sort()
+    return found
+
+
+def capture_buffers(comm, q_group, q_names, q_n, start=None, count=None, stride=None,
+                    cross_trigger=False, trigger=None, decimation=None, load_registers=True):
+    config = comm.get_config()
+    found = find_inserts(config, q_group, q_names, q_n)
+    # Loading the registers restarts the captures of the inserts, including
+    # the one a double-buffered insert makes while the previous is read back.
+    if load_registers:
+        load_capture_registers(comm, config, found, trigger, decimation)
+
+    # Several inserts are armed together, so that they capture at the same
+    # time.
+    print("waiting for trigger...", file=sys.stderr)
+    if len(found) == 1:
+        comm.select(found[0])
+        comm.arm_wait()
+    else:
+        comm.arm_group_wait(found, cross_trigger)
+    print("done", file=sys.stderr)
+    return read_captures(comm, config, found, start, count, stride, decimation)
+
+
+def read_captures(comm, config, found, start=None, count=None, stride=None, decimation=None):
+    # Several inserts must have been armed as a group.
+    readbacks = []
+    for i in found:
+        group, name, width, depth, *_ = config["ins"][i]
+        options = get_insert_options(config["ins"][i])
+        readback_depth = get_readback_depth(width, depth, options)
+        w_start, w_count, w_stride = get_window(readback_depth, start, count, stride)
+        # The timeline of storage-qualified buffers adds up the deltas of all
+        # samples from the trigger, so they are read back whole.
+        if "dtw" in options and w_count != readback_depth:
+            raise SystemExit("Storage-qualified insert {} cannot be read back "
+                             "with a window".format(name))
+        readbacks.append((i, get_word_width(width, options), w_start, w_count, w_stride,
+                          w_count == readback_depth))
+
+    # Complete uncompressed readbacks of several inserts are done at once,
+    # with a CRC after each insert if the device supports checked readback.
+    # The inserts that fail the check are then read again one by one.
+    data = [None]*len(readbacks)
+    if (len(found) > 1 and all(complete for *_, complete in readbacks)
+            and not config.get("cmp", False)):
+        lengths = [w_count*((word_width+7)//8)
+                   for _, word_width, _, w_count, _, _ in readbacks]
+        if config.get("crc", False):
+            data = comm.data_group_checked(lengths)
+        else:
+            group_data = comm.data_group(sum(lengths))
+            offset = 0
+            for n, length in enumerate(lengths):
+                data[n] = group_data[offset:offset+length]
+                offset += length
+    for n, (i, word_width, w_start, w_count, w_stride, complete) in enumerate(readbacks):
+        if data[n] is not None:
+            continue
+        comm.select(i)
+        if not complete:
+            comm.set_window(w_start, w_count, w_stride)
+        if config.get("cmp", False):
+            data[n] = comm.data_compressed(word_width, w_count)
+        elif config.get("crc", False):
+            data[n] = comm.data_verified((word_width+7)//8, w_start, w_count, w_stride)
+        else:
+            data[n] = comm.data(w_count*((word_width+7)//8))
+
+    captures = []
+    for (i, _, w_start, _, w_stride, _), insert_data in zip(readbacks, data):
+        group, name, width, depth, *_ = config["ins"][i]
+        options = get_insert_options(config["ins"][i])
+        captures.append(Capture(config["grp"][group], name, width, depth, options,
+                                w_start, w_stride, insert_data,
+                                (decimation or 1) if "dec" in options else 1))
+    return captures
+
+
+def print_capture(capture):
+    print("[")
+    if "dtw" in capture.options:
+        for time, value in capture.iter_samples():
+            print(hex(value) + ",  # cycle {}".format(time))
+    else:
+        word_len = (capture.width+7)//8
+        segments = capture.get_segments()
+        if segments is None:
+            segments = [(None, capture.data)]
+        trigger_index = capture.get_trigger_index()
+        for timestamp, data in segments:
+            if timestamp is not None:
+                print("# trigger at cycle {}".format(timestamp))
+            for j in range(len(data)//word_len):
+                print(hex(int.from_bytes(data[j*word_len:(j+1)*word_len], "little")) + "," +
+                      ("  # trigger" if j == trigger_index else ""))
+    print("]")
+
+
+def save_capture(capture, output, output_format):
+    import numpy
+    from microscope.decode import get_dtype, decode_samples, split_deltas, expand_timeline, save_samples
+
+    segments = capture.get_segments()
+    if "dtw" in capture.options:
+        if segments is None:
+            segments = [(0, capture.data)]
+        times = []
+        values = []
+        for timestamp, data in segments:
+            words = decode_samples(data, capture.word_width, wide="object")
+            segment_values, deltas = split_deltas(words, capture.width)
+            times.append(timestamp + numpy.cumsum(deltas.astype(numpy.int64)))
+            values.append(segment_values)
+        times = numpy.concatenate(times)
+        samples = expand_timeline(times, numpy.concatenate(values))
+        dtype = get_dtype(capture.width)
+        if dtype is not None:
+            samples = samples.astype(dtype)
+        print("timeline starts at cycle {}".format(times[0]), file=sys.stderr)
+    elif segments is None:
+        samples = decode_samples(capture.data, capture.width)
+        trigger_index = capture.get_trigger_index()
+        if trigger_index is not None:
+            print("trigger at sample {}".format(trigger_index), file=sys.stderr)
+    else:
+        samples = decode_samples(b"".join(data for _, data in segments), capture.width)
+        samples = samples.reshape((len(segments), -1) + samples.shape[1:])
+        for i, (timestamp, _) in enumerate(segments):
+            print("segment {}: trigger at cycle {}".format(i, timestamp), file=sys.stderr)
+    save_samples(output, samples, output_format)
+    print("wrote {} samples, dtype {}, shape {}".format(
+          len(samples), samples.dtype.str, samples.shape), file=sys.stderr)
+
+
+def display_buffer(comm, q_group, q_names, q_n, start=None, count=None, stride=None,
+                   output=None, output_format=None, cross_trigger=False, trigger=None,
+                   decimation=None, repeat=1):
+    if repeat > 1:
+        # Double-buffered inserts capture the next event while the previous
+        # one is read back, which shows in the capture rate.
+        if output is not None:
+            raise SystemExit("Repeated captures can only be printed")
+        started = time.monotonic()
+        # The registers are loaded only once, as loading them again would
+        # discard the capture made during the previous readback.
+        for n in range(repeat):
+            for capture in capture_buffers(comm, q_group, q_names, q_n, start, count, stride,
+                                           cross_trigger, trigger, decimation,
+                                           load_registers=n == 0):
+                print_capture(capture)
+        elapsed = time.monotonic() - started
+        print("{} captures in {:.3f} s ({:.1f}/s)".format(repeat, elapsed, repeat/elapsed),
+              file=sys.stderr)
+        return
+
+    captures = capture_buffers(comm, q_group, q_names, q_n, start, count, stride,
+                               cross_trigger, trigger, decimation)
+    if output is None:
+        for capture in captures:
+            print_capture(capture)
+    else:
+        if output_format is None:
+            if output.endswith(".npy"):
+                output_format = "npy"
+            elif output.endswith(".vcd"):
+                output_format = "vcd"
+            else:
+                output_format = "raw"
+        if output_format == "vcd":
+            # Times are in sample clock cycles, which are only converted to
+            # seconds when all inserts sample at the same known frequency.
+            clk_freqs = {capture.options.get("clk") for capture in captures}
+            clk_freq = clk_freqs.pop() if len(clk_freqs) == 1 else None
+            write_vcd(output, [(capture.group, capture.name, capture.width, capture.iter_samples())
+                               for capture in captures], clk_freq=clk_freq)
+        else:
+            if len(captures) > 1:
+                raise SystemExit("More than one insert matches")
+            save_capture(captures[0], output, output_format)
+
+
+def capture_device(port_url, baudrate, cache_dir, negotiate, max_baudrate,
+                   q_group, q_names, q_n, cross_trigger, barrier, timeout, trigger=None,
+                   decimation=None):
+    comm = Comm(port_url, baudrate, cache_dir)
+    try:
+        try:
+            if negotiate:
+                comm.negotiate_baudrate(max_baudrate)
+            config = comm.get_config()
+            found = find_inserts(config, q_group, q_names, q_n)
+            load_capture_registers(comm, config, found, trigger, decimation)
+            if len(found) == 1:
+                comm.select(found[0])
+        except BaseException:
+            barrier.abort()
+            raise
+        barrier.wait()
+        armed_at = time.time()
+        sent_at = []
+        if len(found) == 1:
+            done = comm.arm_wait(timeout, lambda: sent_at.append(time.time()))
+        else:
+            done = comm.arm_group_wait(found, cross_trigger, timeout,
+                                       lambda: sent_at.append(time.time()))
+        if not done:
+            raise TimeoutError("Timeout waiting for trigger on " + port_url)
+        completed_at = time.time()
+        arm_latency = sent_at[0] - armed_at
+        captures = read_captures(comm, config, found, decimation=decimation)
+        return {
+            "port": port_url,
+            "armed_at": armed_at,
+            "arm_latency": arm_latency,
+            "completed_at": completed_at,
+            "captures": captures
+        }
+    finally:
+        comm.close()
+
+
+def capture_devices(port_urls, baudrate, cache_dir, negotiate, max_baudrate,
+                    q_group, q_names, q_n, cross_trigger=False, timeout=None, trigger=None,
+                    decimation=None):
+    """Arms the matching inserts on all devices at the same time, from one
+    thread per device, and reads back the captures in parallel."""
+    barrier = threading.Barrier(len(port_urls))
+    with concurrent.futures.ThreadPoolExecutor(len(port_urls)) as executor:
+        futures = [executor.submit(capture_device, port_url, baudrate, cache_dir,
+                                   negotiate, max_baudrate, q_group, q_names, q_n,
+                                   cross_trigger, barrier, timeout, trigger, decimation)
+                   for port_url in port_urls]
+        return [future.result() for future in futures]
+
+
+def write_archive(output, results):
+    """Writes the captures of several devices into a ZIP archive, with a
+    ``manifest.json`` describing the raw capture files."""
+    first_arm = min(result["armed_at"] for result in results)
+    manifest = {"devices": []}
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for n, result in enumerate(results):
+            device = {
+                "port": result["port"],
+                "armed_at": result["armed_at"],
+                "arm_offset": result["armed_at"] - first_arm,
+                "arm_latency": result["arm_latency"],
+                "completed_at": result["completed_at"],
+                "captures": []
+            }
+            for capture in result["captures"]:
+                filename = "{}/{}.{}.{}.raw".format(n, capture.group, capture.name,
+                                                    len(device["captures"]))
+                archive.writestr(filename, capture.data)
+                device["captures"].append({
+                    "group": capture.group,
+                    "name": capture.name,
+                    "width": capture.width,
+                    "depth": capture.depth,
+                    "options": capture.options,
+                    "decimation": capture.decimation,
+                    "file": filename
+                })
+            manifest["devices"].append(device)
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+
+
+def add_capture_arguments(parser):
+    parser.add_argument("--trigger", metavar="COND", type=parse_condition, default=None,
+                        help="programmable trigger condition [MODE:]VALUE[/MASK], with MODE "
+                             "one of level (default), rise, fall; or change[/MASK]")
+    parser.add_argument("--then", metavar="COND", type=parse_condition, default=None,
+                        help="trigger on this condition when it follows --trigger "
+                             "within --within cycles")
+    parser.add_argument("--within", metavar="CYCLES", type=int, default=0,
+                        help="window for --then, in cycles")
+    parser.add_argument("--decimate", metavar="N", type=int, default=None,
+                        help="store one sample every N cycles")
+
+
+def get_trigger(parser, args):
+    if args.trigger is None:
+        if args.then is not None or args.within:
+            parser.error("--then and --within require --trigger")
+        return None
+    if (args.then is None) != (args.within == 0):
+        parser.error("--then and --within must be used together")
+    return args.trigger, args.then, args.within
 
 
 def main():
     parser = argparse.ArgumentParser(description="Microscope FPGA logic analyzer client")
     parser.add_argument("port", help="serial port URL (see open_for_url in pyserial)")
+    parser.add_argument("-b", "--baudrate", type=int, default=115200,
+                        help="initial baud rate of the target device (default: %(default)s)")
+    parser.add_argument("--max-baudrate", type=int, default=None,
+                        help="do not negotiate baud rates above this value")
+    parser.add_argument("--no-negotiate", action="store_true",
+                        help="stay at the initial baud rate")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always download the configuration from the device")
     subparsers = parser.add_subparsers(dest="action")
     subparsers.add_parser("inserts", help="list inserts available on the target device")
-    subparsers.add_parser("singles", help="show current values of single-value inserts")
+    parser_singles = subparsers.add_parser("singles", help="show current values of single-value inserts")
+    parser_singles.add_argument("group", metavar="GROUP", nargs="?", default=None,
+                                help="only show inserts of this group")
+    parser_counters = subparsers.add_parser("counters", help="show rates and duty cycles of event counters")
+    parser_counters.add_argument("group", metavar="GROUP", nargs="?", default=None,
+                                 help="only show counters of this group")
+    parser_counters.add_argument("-i", "--interval", type=float, default=1.0,
+                                 help="seconds to count for (default: %(default)s)")
+    parser_counters.add_argument("-w", "--watch", action="store_true",
+                                 help="keep counting and show the counts of each interval")
+    parser_histogram = subparsers.add_parser("histogram", help="show percentiles of a histogram insert")
+    parser_histogram.add_argument("group", metavar="GROUP")
+    parser_histogram.add_argument("name", metavar="NAME")
+    parser_histogram.add_argument("-n", type=int, default=None,
+                                  help="index (in case of multiple matches)")
+    parser_histogram.add_argument("-i", "--interval", type=float, default=1.0,
+                                  help="accumulation time in seconds, for histograms without "
+                                       "a set duration (default: %(default)s)")
+    parser_histogram.add_argument("--bins", action="store_true",
+                                  help="also show the count of each bin")
     parser_monitor = subparsers.add_parser("monitor", help="continously monitor the value of a single-value insert")
     parser_monitor.add_argument("group", metavar="GROUP")
     parser_monitor.add_argument("name", metavar="NAME")
     parser_monitor.add_argument("-n", type=int, default=None,
                                 help="index (in case of multiple matches)")
+    parser_stream = subparsers.add_parser("stream",
+        help="capture single-value inserts at a fixed interval and log them")
+    parser_stream.add_argument("group", metavar="GROUP")
+    parser_stream.add_argument("name", metavar="NAME", nargs="+",
+                               help="inserts to capture at each interval")
+    parser_stream.add_argument("-n", type=int, default=None,
+                               help="index (in case of multiple matches)")
+    parser_stream.add_argument("-i", "--interval", type=float, default=1e-3,
+                               help="seconds between captures (default: %(default)s)")
+    parser_stream.add_argument("-o", "--output", default=None,
+                               help="binary file to log the captures into")
+    parser_stream.add_argument("--duration", type=float, default=None,
+                               help="stop after this many seconds (default: until interrupted)")
     parser_buffer = subparsers.add_parser("buffer", help="show values of a buffering insert")
     parser_buffer.add_argument("group", metavar="GROUP")
-    parser_buffer.add_argument("name", metavar="NAME")
+    parser_buffer.add_argument("name", metavar="NAME", nargs="+",
+                               help="inserts to capture at the same time")
     parser_buffer.add_argument("-n", type=int, default=None,
                                help="index (in case of multiple matches)")
+    parser_buffer.add_argument("-x", "--cross-trigger", action="store_true",
+                               help="trigger all inserts when one of them triggers")
+    add_capture_arguments(parser_buffer)
+    parser_buffer.add_argument("--start", type=int, default=None,
+                               help="first sample to read back")
+    parser_buffer.add_argument("--count", type=int, default=None,
+                               help="number of samples to read back")
+    parser_buffer.add_argument("--stride", type=int, default=None,
+                               help="distance between samples read back")
+    parser_buffer.add_argument("-o", "--output", default=None,
+                               help="write the samples into a file instead of printing them")
+    parser_buffer.add_argument("-f", "--format", choices=["npy", "raw", "vcd"], default=None,
+                               help="output file format (default: from the file extension)")
+    parser_buffer.add_argument("-r", "--repeat", type=int, default=1,
+                               help="capture and print this many times")
+    parser_capture = subparsers.add_parser("capture",
+        help="capture buffering inserts on several devices at the same time")
+    parser_capture.add_argument("group", metavar="GROUP")
+    parser_capture.add_argument("name", metavar="NAME", nargs="+",
+                                help="inserts to capture on each device")
+    parser_capture.add_argument("-n", type=int, default=None,
+                                help="index (in case of multiple matches)")
+    parser_capture.add_argument("-d", "--device", metavar="PORT", action="append", default=[],
+                                help="serial port URL of another device (repeatable)")
+    parser_capture.add_argument("-x", "--cross-trigger", action="store_true",
+                                help="trigger all inserts of a device when one of them triggers")
+    add_capture_arguments(parser_capture)
+    parser_capture.add_argument("-t", "--timeout", type=float, default=None,
+                                help="give up waiting for triggers after this many seconds")
+    parser_capture.add_argument("-o", "--output", required=True,
+                                help="ZIP archive to write the captures into")
     args = parser.parse_args()
 
-    comm = Comm(args.port)
+    cache_dir = None if args.no_cache else get_default_cache_dir()
+    if args.action == "capture":
+        results = capture_devices([args.port] + args.device, args.baudrate, cache_dir,
+                                  not args.no_negotiate, args.max_baudrate,
+                                  args.group, args.name, args.n, args.cross_trigger,
+                                  args.timeout, get_trigger(parser, args), args.decimate)
+        write_archive(args.output, results)
+        for result in results:
+            print("{}: arm latency {:.3f} ms, captured after {:.3f} s".format(
+                  result["port"], result["arm_latency"]*1e3,
+                  result["completed_at"] - result["armed_at"]), file=sys.stderr)
+        return
+
+    comm = Comm(args.port, args.baudrate, cache_dir)
     try:
+        if not args.no_negotiate:
+            comm.negotiate_baudrate(args.max_baudrate)
         if args.action is None or args.action == "inserts":
             display_inserts(comm)
         elif args.action == "singles":
-            display_singles(comm)
+            display_singles(comm, args.group)
+        elif args.action == "counters":
+            display_counters(comm, args.group, args.interval, args.watch)
+        elif args.action == "histogram":
+            display_histogram(comm, args.group, args.name, args.n, args.interval, args.bins)
         elif args.action == "monitor":
             monitor_single(comm, args.group, args.name, args.n)
+        elif args.action == "stream":
+            stream_singles(comm, args.group, args.name, args.n, args.interval,
+                           args.output, args.duration)
         elif args.action == "buffer":
-            display_buffer(comm, args.group, args.name, args.n)
+            display_buffer(comm, args.group, args.name, args.n,
+                           args.start, args.count, args.stride,
+                           args.output, args.format, args.cross_trigger,
+                           get_trigger(parser, args), args.decimate, args.repeat)
     finally:
         comm.close()
 
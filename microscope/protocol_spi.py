@@ -0,0 +1,128 @@
+"""pyserial URL handler for devices built with the SPI PHY (``spi.SPISlave``).
+
+URL format: ``spi:///dev/spidevB.C[?speed=HZ]``. Requires the ``spidev``
+package. The baud rate is ignored; the SPI clock is set by ``speed``
+(default: 1 MHz), which must be at most a tenth of the device clock.
+"""
+
+import re
+import time
+import urllib.parse
+
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError, to_bytes
+
+
+class Serial(SerialBase):
+    # Limited by the header byte that holds the length of a transfer.
+    max_transfer = 255
+    poll_transfer = 16
+
+    def __init__(self, *args, **kwargs):
+        self.spi = None
+        self.speed = 1000000
+        self.buffer = bytearray()
+        super().__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        path = self.from_url(self.port)
+        m = re.search(r"spidev(\d+)\.(\d+)$", path)
+        if m is None:
+            raise SerialException("Expected a spidev device, got {!r}".format(path))
+        try:
+            import spidev
+        except ImportError:
+            raise SerialException("spi:// URLs require the spidev package")
+        self.spi = spidev.SpiDev()
+        try:
+            self.spi.open(int(m.group(1)), int(m.group(2)))
+        except OSError as e:
+            raise SerialException("Could not open {}: {}".format(path, e))
+        self.spi.mode = 0
+        self.spi.max_speed_hz = self.speed
+        self.is_open = True
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.spi is not None:
+            self.spi.close()
+            self.spi = None
+        self.is_open = False
+
+    def from_url(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme != "spi":
+            raise SerialException("Expected an spi:// URL, got {!r}".format(url))
+        for option, values in urllib.parse.parse_qs(parts.query, True).items():
+            if option == "speed":
+                self.speed = int(values[0])
+            else:
+                raise SerialException("Unknown option: {!r}".format(option))
+        return parts.path
+
+    def _reconfigure_port(self, force_update=False):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_dtr_state(self):
+        pass
+
+    def _update_break_state(self):
+        pass
+
+    def transfer(self, length, data=b""):
+        """Clocks ``length`` bytes after the header, the first of which are
+        ``data``, and buffers the bytes sent by the device. Returns the
+        number of bytes received."""
+        if not self.is_open:
+            raise PortNotOpenError()
+        sent = bytes([length, len(data)]) + data + bytes(length - len(data))
+        reply = self.spi.xfer2(list(sent))
+        self.buffer += bytes(reply[2:2+reply[1]])
+        return reply[1]
+
+    @property
+    def in_waiting(self):
+        # The device can only send when it is clocked, so poll it once.
+        self.transfer(self.poll_transfer)
+        return len(self.buffer)
+
+    def read(self, size=1):
+        if self._timeout is not None:
+            deadline = time.monotonic() + self._timeout
+        # The device only sends the bytes it had when a transfer started, so
+        # it is polled with short transfers until data flows.
+        length = self.poll_transfer
+        while len(self.buffer) < size:
+            if self.transfer(min(size - len(self.buffer), length)):
+                length = self.max_transfer
+            else:
+                length = self.poll_transfer
+                if self._timeout is not None and time.monotonic() >= deadline:
+                    break
+                # Let the device prepare the reply.
+                time.sleep(0.0001)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def write(self, data):
+        data = to_bytes(data)
+        for i in range(0, len(data), self.max_transfer):
+            chunk = data[i:i+self.max_transfer]
+            self.transfer(len(chunk), chunk)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.buffer = bytearray()
+
+    def reset_output_buffer(self):
+        pass
@@ -0,0 +1,120 @@
+from migen import *
+from migen.genlib.cdc import MultiReg
+from migen.genlib.fifo import SyncFIFO
+
+
+class SPISlave(Module):
+    """SPI slave (mode 0, MSB first) with the same byte interface as the UART.
+
+    Each transfer (between assertion and deassertion of chip select) starts
+    with two header bytes. The host sends the number of bytes that follow
+    the header, then how many of them are valid data. The device replies
+    with a zero byte, then the number of valid data bytes it sends in the
+    same transfer. Bytes to send are queued in a FIFO of ``fifo_depth``
+    entries, so that the device only commits to bytes it already has. The
+    FIFO refills while a transfer is clocked, so with the default depth,
+    long readbacks proceed with transfers of 255 bytes.
+
+    ``pads`` has ``clk``, ``cs_n``, ``mosi`` and ``miso``. The pins are
+    oversampled by the system clock, which must be at least ten times
+    faster than the SPI clock.
+    """
+    def __init__(self, pads, fifo_depth=256):
+        self.rx_data = Signal(8)
+        self.rx_stb = Signal()
+
+        self.tx_data = Signal(8)
+        self.tx_stb = Signal()
+        self.tx_ack = Signal()
+
+        # # #
+
+        fifo = SyncFIFO(8, fifo_depth)
+        self.submodules += fifo
+        self.comb += [
+            fifo.din.eq(self.tx_data),
+            fifo.we.eq(self.tx_stb & ~self.tx_ack)
+        ]
+        self.sync += self.tx_ack.eq(fifo.we & fifo.writable)
+
+        clk = Signal()
+        cs_n = Signal(reset=1)
+        mosi = Signal()
+        self.specials += [
+            MultiReg(pads.clk, clk),
+            MultiReg(pads.cs_n, cs_n, reset=1),
+            MultiReg(pads.mosi, mosi)
+        ]
+        clk_r = Signal()
+        self.sync += clk_r.eq(clk)
+        rising = Signal()
+        falling = Signal()
+        self.comb += [
+            rising.eq(~cs_n & clk & ~clk_r),
+            falling.eq(~cs_n & ~clk & clk_r)
+        ]
+
+        bitcount = Signal(3)
+        header = Signal(max=3)
+        rx_reg = Signal(7)
+        rx_byte = Signal(8)
+        tx_reg = Signal(8)
+        length = Signal(8)
+        rx_remaining = Signal(8)
+        tx_remaining = Signal(8)
+        tx_count = Signal(8)
+        self.comb += [
+            pads.miso.eq(tx_reg[7]),
+            rx_byte.eq(Cat(mosi, rx_reg)),
+            If(fifo.level < length,
+                tx_count.eq(fifo.level)
+            ).Else(
+                tx_count.eq(length)
+            )
+        ]
+        self.sync += [
+            self.rx_stb.eq(0),
+            If(cs_n,
+                bitcount.eq(0),
+                header.eq(0),
+                tx_reg.eq(0),
+                tx_remaining.eq(0)
+            ),
+            If(rising,
+                bitcount.eq(bitcount + 1),
+                rx_reg.eq(rx_byte),
+                If(bitcount == 7,
+                    If(header == 0,
+                        length.eq(rx_byte)
+                    ).Elif(header == 1,
+                        rx_remaining.eq(rx_byte)
+                    ).Elif(rx_remaining != 0,
+                        self.rx_data.eq(rx_byte),
+                        self.rx_stb.eq(1),
+                        rx_remaining.eq(rx_remaining - 1)
+                    ),
+                    If(header != 2,
+                        header.eq(header + 1)
+                    )
+                )
+            ),
+            # The next byte is loaded on the falling edge that ends the
+            # previous one.
+            If(falling,
+                If(bitcount == 0,
+                    If(header == 1,
+                        tx_reg.eq(tx_count),
+                        tx_remaining.eq(tx_count)
+                    ).Elif(tx_remaining != 0,
+                        tx_reg.eq(fifo.dout),
+                        tx_remaining.eq(tx_remaining - 1)
+                    ).Else(
+                        tx_reg.eq(0)
+                    )
+                ).Else(
+                    tx_reg.eq(Cat(0, tx_reg))
+                )
+            )
+        ]
+        self.comb += fifo.re.eq(falling & (bitcount == 0) & (header == 2) &
+                                (tx_remaining != 0))
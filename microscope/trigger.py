@@ -0,0 +1,114 @@
+from migen import *
+from migen.genlib.cdc import MultiReg
+
+
+__all__ = ["TriggerUnit", "get_trigger_length"]
+
+
+# Comparator modes
+LEVEL = 0
+RISE = 1
+FALL = 2
+CHANGE = 3
+
+
+def get_trigger_length(width, sequence_width):
+    """Number of bytes of the registers of a trigger unit."""
+    return 4*((width+7)//8) + 1 + (sequence_width+7)//8
+
+
+class TriggerUnit(Module):
+    """Trigger condition on ``target`` set at run time.
+
+    Two comparators A and B match when the bits of ``target`` selected by
+    their mask equal those of their value. Each comparator fires, depending
+    on its mode, while it matches (``LEVEL``), when it starts or stops
+    matching (``RISE``, ``FALL``), or when any of the masked bits changes
+    (``CHANGE``). With a window of zero, ``trigger`` is the output of A.
+    Otherwise, it asserts when B fires at most that many cycles after A,
+    and each firing of A restarts the window. ``clear`` resets the window.
+
+    The registers are shifted in through ``load_data`` and ``load_stb`` in
+    the microscope domain, and take effect on ``load_commit``. Their bytes
+    are, in little-endian order: value and mask of A, value and mask of B
+    (each of the byte size of ``target``), the modes (bits 0-1: A, bits 2-3:
+    B) and the window (``sequence_width`` bits). They reach ``clock_domain``
+    through synchronizers, so a capture that uses ``trigger`` should be
+    restarted after ``load_commit``. After reset, A matches all values and
+    the window is zero, so that the unit always triggers.
+    """
+    def __init__(self, target, clock_domain="sys", sequence_width=16):
+        self.load_data = Signal(8)
+        self.load_stb = Signal()
+        self.load_commit = Signal()
+        self.clear = Signal()
+        self.trigger = Signal()
+
+        # # #
+
+        width = len(target)
+        word_len = (width+7)//8
+        length = get_trigger_length(width, sequence_width)
+        if length > 255:
+            raise ValueError("Target too wide for a trigger unit")
+
+        shift = Signal(8*length)
+        registers = Signal(8*length)
+        registers.attr.add("no_retiming")
+        self.sync.microscope += [
+            If(self.load_stb,
+                shift.eq(Cat(shift[8:], self.load_data))
+            ),
+            If(self.load_commit,
+                registers.eq(shift)
+            )
+        ]
+        registers_sync = Signal(8*length)
+        self.specials += MultiReg(registers, registers_sync, clock_domain)
+
+        fields = [registers_sync[8*i*word_len:8*i*word_len + width] for i in range(4)]
+        modes = registers_sync[8*4*word_len:8*4*word_len + 8]
+        window = registers_sync[8*4*word_len + 8:8*4*word_len + 8 + sequence_width]
+
+        sync = getattr(self.sync, clock_domain)
+        last_target = Signal(width)
+        sync += last_target.eq(target)
+        fire = []
+        for i, (value, mask) in enumerate([fields[0:2], fields[2:4]]):
+            match = Signal()
+            last_match = Signal()
+            comparator_fire = Signal()
+            self.comb += [
+                match.eq((target & mask) == (value & mask)),
+                Case(modes[2*i:2*i+2], {
+                    LEVEL: comparator_fire.eq(match),
+                    RISE: comparator_fire.eq(match & ~last_match),
+                    FALL: comparator_fire.eq(~match & last_match),
+                    CHANGE: comparator_fire.eq(((target ^ last_target) & mask) != 0)
+                })
+            ]
+            sync += last_match.eq(match)
+            fire.append(comparator_fire)
+
+        waiting = Signal()
+        remaining = Signal(sequence_width)
+        sync += [
+            If(waiting,
+                remaining.eq(remaining - 1),
+                If(remaining == 1,
+                    waiting.eq(0)
+                )
+            ),
+            If(fire[0] & (window != 0),
+                waiting.eq(1),
+                remaining.eq(window)
+            ),
+            If(self.clear,
+                waiting.eq(0)
+            )
+        ]
+        self.comb += If(window == 0,
+            self.trigger.eq(fire[0])
+        ).Else(
+            self.trigger.eq(waiting & fire[1])
+        )
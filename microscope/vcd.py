@@ -0,0 +1,96 @@
+import heapq
+import itertools
+
+
+__all__ = ["iter_samples", "get_timescale", "vcd_lines", "write_vcd"]
+
+
+def iter_samples(data, width, start=0, stride=1):
+    """Yields ``(time, value)`` pairs from readback data, one time unit
+    per sample clock cycle."""
+    word_len = (width+7)//8
+    for i in range(len(data)//word_len):
+        yield start + i*stride, int.from_bytes(data[i*word_len:(i+1)*word_len], "little")
+
+
+def _identifiers():
+    alphabet = [chr(c) for c in range(33, 127)]
+    for length in itertools.count(1):
+        for identifier in itertools.product(alphabet, repeat=length):
+            yield "".join(identifier)
+
+
+def _format_value(value, width, identifier):
+    if width == 1:
+        return "{}{}".format(value & 1, identifier)
+    else:
+        return "b{:b} {}".format(value, identifier)
+
+
+def get_timescale(clk_freq):
+    """Returns the VCD timescale for samples of a ``clk_freq`` clock, and
+    the number of its units in a cycle. The timescale is the largest that
+    divides the cycle, down to 1 ps; below, cycle times are rounded."""
+    units = 1e12/clk_freq
+    exponent = 0
+    if abs(units - round(units)) < 1e-6:
+        units = round(units)
+        while units % 10 == 0 and exponent < 14:
+            units //= 10
+            exponent += 1
+    return "{} {}".format(10**(exponent % 3), ["ps", "ns", "us", "ms", "s"][exponent//3]), units
+
+
+def _tag_samples(samples, n, units):
+    for time, value in samples:
+        yield round(time*units), n, value
+
+
+def vcd_lines(signals, timescale="1 ns", clk_freq=None):
+    """Generates the lines of a VCD file.
+
+    ``signals`` is a list of ``(scope, name, width, samples)`` tuples where
+    ``samples`` iterates over ``(time, value)`` pairs in increasing time
+    order, in cycles of the sample clock. With ``clk_freq``, the frequency
+    of that clock, the timescale is derived from it. Otherwise, one
+    ``timescale`` unit stands for one cycle. The samples are consumed
+    lazily and merged across signals, and only value changes are emitted.
+    Signals of the same scope are declared together, in the order the
+    scopes first appear.
+    """
+    units = 1
+    if clk_freq is not None:
+        timescale, units = get_timescale(clk_freq)
+    yield "$timescale {} $end".format(timescale)
+    identifiers = list(itertools.islice(_identifiers(), len(signals)))
+    scopes = {}
+    for n, (scope, *_) in enumerate(signals):
+        scopes.setdefault(scope, []).append(n)
+    for scope, scope_signals in scopes.items():
+        yield "$scope module {} $end".format(scope.replace(" ", "_"))
+        for n in scope_signals:
+            _, name, width, _ = signals[n]
+            yield "$var wire {} {} {} $end".format(width, identifiers[n], name.replace(" ", "_"))
+        yield "$upscope $end"
+    yield "$enddefinitions $end"
+
+    streams = [_tag_samples(samples, n, units) for n, (_, _, _, samples) in enumerate(signals)]
+    last_values = [None]*len(signals)
+    current_time = None
+    for time, n, value in heapq.merge(*streams):
+        if value == last_values[n]:
+            continue
+        if time != current_time:
+            yield "#{}".format(time)
+            current_time = time
+        last_values[n] = value
+        yield _format_value(value, signals[n][2], identifiers[n])
+    if current_time is not None:
+        yield "#{}".format(current_time + max(round(units), 1))
+
+
+def write_vcd(filename, signals, timescale="1 ns", clk_freq=None):
+    with open(filename, "w") as f:
+        for line in vcd_lines(signals, timescale, clk_freq):
+            f.write(line)
+            f.write("\n")
@@ -31,8 +31,10 @@ setup(
     ],
     packages=find_packages(),
     install_requires=["migen", "pyserial", "msgpack>=1.0.0", "prettytable"],
+    extras_require={"numpy": ["numpy"], "spi": ["spidev"]},
     include_package_data=True,
     entry_points={
-        "console_scripts": ["microscope = microscope.microscope:main"],
+        "console_scripts": ["microscope = microscope.microscope:main",
+                            "microscope-emulator = microscope.emulator:main"],
     },
 )